@@ -37,3 +37,161 @@ def clean():
     for p in path(__file__).abspath().parent.walkfiles():
         if p.endswith(".pyc") or p.endswith(".pyo"):
             p.remove()
+
+@task
+@cmdopts([
+    ('runs=', 'n', 'how many times to start tkt'),
+    ('budget=', 'b', 'the most seconds a median start may take'),
+])
+def bench_startup(options):
+    "time 'tkt help' and fail if a typical start goes over budget"
+    import os
+    import subprocess
+    import sys
+    import time
+
+    runs = int(options.bench_startup.get('runs', 15))
+    budget = float(options.bench_startup.get('budget', 0.4))
+
+    root = path(__file__).abspath().parent
+    env = dict(os.environ, PYTHONPATH=root)
+    command = [sys.executable, root / "scripts" / "tkt", "help"]
+
+    timings = []
+    for i in xrange(runs):
+        start = time.time()
+        subprocess.check_call(command, env=env, stdout=open(os.devnull, 'w'))
+        timings.append(time.time() - start)
+    timings.sort()
+
+    median = timings[len(timings) // 2]
+    print "tkt help: median %.3fs, best %.3fs over %d runs (budget %.3fs)" % (
+            median, timings[0], runs, budget)
+    if median > budget:
+        raise BuildFailure("tkt help took %.3fs, over the %.3fs budget" % (
+                median, budget))
+
+@task
+@cmdopts([
+    ('processes=', 'n', 'how many tkt processes to run at once'),
+    ('tickets=', 't', 'how many tickets to spread them over (default 1)'),
+    ('storage=', 's', 'the storage backend to use (default files)'),
+    ('batch=', 'b', 'how many more labels to add from one tkt batch'),
+])
+def stress_locking(options):
+    "label tickets from many processes at once and check nothing's lost"
+    import os
+    import shutil
+    import subprocess
+    import sys
+    import tempfile
+    import yaml
+
+    processes = int(options.stress_locking.get('processes', 16))
+    tickets = int(options.stress_locking.get('tickets', 1))
+    storage = options.stress_locking.get('storage', 'files')
+    batch = int(options.stress_locking.get('batch', 0))
+
+    root = path(__file__).abspath().parent
+    workdir = tempfile.mkdtemp(prefix="tkt-stress-")
+    env = dict(os.environ, PYTHONPATH=root, HOME=workdir, EDITOR="true")
+
+    def tkt(*args, **kwargs):
+        return subprocess.Popen(
+                [sys.executable, root / "scripts" / "tkt"] + list(args),
+                cwd=workdir, env=env, stdin=subprocess.PIPE,
+                stdout=open(os.devnull, 'w'), **kwargs)
+
+    try:
+        tkt("init", "-i", "tkt.plugins.labels").communicate("")
+        for i in xrange(tickets):
+            tkt("add", "-t", "contended %d" % i, "-p", "f").communicate(
+                    "stress test")
+        if storage != 'files':
+            tkt("convert", storage).communicate("")
+
+        # different tickets get written at the same time, the same one in turn
+        workers = []
+        if batch:
+            # its groups hold their locks for many labels at a time
+            batcher = tkt("batch")
+            batcher.stdin.write("".join("label %d batch-%d\n" % (
+                    i % tickets, i) for i in xrange(batch)))
+            batcher.stdin.close()
+            workers.append(batcher)
+        workers.extend(tkt("label", str(i % tickets), "label-%d" % i)
+                       for i in xrange(processes))
+        for worker in workers[bool(batch):]:
+            worker.stdin.close()
+        failed = sum(1 for worker in workers if worker.wait())
+
+        if storage != 'files':
+            tkt("convert", "files").communicate("")
+
+        labels = events = 0
+        ticketsdir = os.path.join(workdir, ".tkt", "tickets")
+        for name in os.listdir(ticketsdir):
+            ticketdir = os.path.join(ticketsdir, name)
+            ticket = yaml.load(open(os.path.join(ticketdir, "ticket.yaml")))
+            labels += len(ticket.get('labels') or [])
+            # ticket.yaml and the ticket created event aren't labelings
+            events += len(os.listdir(ticketdir)) - 2
+
+        print "%d processes on %d %s ticket(s): %d failed, %d labels and " \
+              "%d events stored" % (processes, tickets, storage, failed,
+                                    labels, events)
+        if failed or labels != processes + batch or \
+                events != processes + batch:
+            raise BuildFailure("concurrent updates were lost")
+    finally:
+        shutil.rmtree(workdir)
+
+@task
+@cmdopts([
+    ('processes=', 'n', 'how many tickets to add at once'),
+])
+def stress_numbering(options):
+    "add tickets from many processes at once and check their numbers differ"
+    import collections
+    import os
+    import shutil
+    import subprocess
+    import sys
+    import tempfile
+    import yaml
+
+    processes = int(options.stress_numbering.get('processes', 36))
+
+    root = path(__file__).abspath().parent
+    workdir = tempfile.mkdtemp(prefix="tkt-stress-")
+    env = dict(os.environ, PYTHONPATH=root, HOME=workdir, EDITOR="true")
+
+    def tkt(*args):
+        return subprocess.Popen(
+                [sys.executable, root / "scripts" / "tkt"] + list(args),
+                cwd=workdir, env=env, stdin=subprocess.PIPE,
+                stdout=open(os.devnull, 'w'))
+
+    try:
+        tkt("init", "-i", "").communicate("")
+        workers = [tkt("add", "-t", "ticket %d" % i, "-p", "f")
+                   for i in xrange(processes)]
+        for worker in workers:
+            worker.stdin.write("stress test")
+            worker.stdin.close()
+        failed = sum(1 for worker in workers if worker.wait())
+
+        numbers = collections.Counter()
+        ticketsdir = os.path.join(workdir, ".tkt", "tickets")
+        for name in os.listdir(ticketsdir):
+            ticket = yaml.load(open(os.path.join(ticketsdir, name,
+                                                 "ticket.yaml")))
+            numbers[ticket.get('number')] += 1
+        shared = sum(count for count in numbers.itervalues() if count > 1)
+
+        print "%d processes: %d failed, %d tickets, %d sharing a number" % (
+                processes, failed, sum(numbers.values()), shared)
+        if failed or sum(numbers.values()) != processes or shared:
+            raise BuildFailure("tickets were given the same number")
+    finally:
+        shutil.rmtree(workdir)
@@ -0,0 +1,90 @@
+"""tickets grouped by their fields, in a single pass over them
+
+a grouping is a field name, a function of a ticket, or a tuple of those for
+grouping by several at once. a list value (like a ticket's labels) puts the
+ticket in a group for each item, and an empty one in none. every grouping
+of an Aggregate gets filled in the same pass, and the groups keep the
+tickets in the order they came in.
+"""
+import collections
+import itertools
+import operator
+
+
+class Group(object):
+    "the tickets sharing a key, or just how many of them there are"
+
+    def __init__(self, key):
+        self.key = key
+        self.count = 0
+        self.issues = []
+
+def _values(value):
+    if isinstance(value, list):
+        return value
+    return [value]
+
+def keyfunc(grouping):
+    "a function of a ticket returning the keys of the groups it goes in"
+    if isinstance(grouping, tuple):
+        funcs = map(keyfunc, grouping)
+        return lambda issue: list(itertools.product(
+                *[func(issue) for func in funcs]))
+    if callable(grouping):
+        return lambda issue: _values(grouping(issue))
+    getter = operator.attrgetter(grouping)
+    return lambda issue: _values(getter(issue))
+
+def field(name, default=None):
+    "a grouping by a field, with default standing in for any empty value"
+    return lambda issue: getattr(issue, name) or default
+
+class Aggregate(object):
+    def __init__(self, groupings, members=True):
+        self.groupings = list(groupings)
+        self.members = members
+        self._funcs = map(keyfunc, self.groupings)
+        self._groups = [collections.OrderedDict() for g in self.groupings]
+
+    def add(self, issue):
+        for func, groups in itertools.izip(self._funcs, self._groups):
+            for key in func(issue):
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = Group(key)
+                group.count += 1
+                if self.members:
+                    group.issues.append(issue)
+
+    def extend(self, issues):
+        for issue in issues:
+            self.add(issue)
+        return self
+
+    def __getitem__(self, grouping):
+        "{key: Group} for one of the groupings, in the order first seen"
+        return self._groups[self.groupings.index(grouping)]
+
+    def group(self, grouping, key):
+        return self[grouping].get(key) or Group(key)
+
+    def issues(self, grouping, key):
+        return self.group(grouping, key).issues
+
+    def counts(self, grouping):
+        return dict((key, group.count)
+                    for key, group in self[grouping].iteritems())
+
+def aggregate(issues, *groupings, **kwargs):
+    """group the tickets every way asked for, going over them once
+
+    pass members=False when only the counts are wanted.
+    """
+    return Aggregate(groupings, kwargs.get('members', True)).extend(issues)
+
+def split(counts):
+    "{(a, b, ...): count} as {a: {(b, ...): count}}"
+    result = {}
+    for key, count in counts.iteritems():
+        result.setdefault(key[0], {})[key[1:]] = count
+    return result
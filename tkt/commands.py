@@ -1,22 +1,38 @@
+import StringIO
+import collections
+import copy
 import datetime
 import functools
 import glob
+import heapq
 import itertools
+import json
 import operator
 import optparse
 import os
 import re
+import select
+import shlex
 import shutil
 import subprocess
 import sys
 import tempfile
 import time
+import traceback
 import uuid
 
+import tkt.aggregate
 import tkt.files
 import tkt.models
 import tkt.config
 import tkt.getplugins
+import tkt.history
+import tkt.index
+import tkt.locking
+import tkt.scan
+import tkt.storage
+import tkt.sync
+import tkt.textindex
 import yaml
 
 
@@ -38,26 +54,108 @@ def dump_yaml(*args, **kwargs):
     return _dump(*args, Dumper=dumper_class, **kwargs)
 yaml.dump = dump_yaml
 
+def split_revision(args):
+    "the arguments without any --rev option, and the git revision it named"
+    args = list(args)
+    for i, arg in enumerate(args):
+        if arg == '--rev' and i + 1 < len(args):
+            return args[:i] + args[i + 2:], args[i + 1]
+        if arg.startswith('--rev='):
+            return args[:i] + args[i + 1:], arg[6:]
+    return args, None
+
 def main():
-    tkt.getplugins.getplugins()
-    if len(sys.argv) > 1 and sys.argv[1] and not sys.argv[1].startswith('-'):
-        arg = sys.argv[1]
+    args, rev = split_revision(sys.argv[1:])
+    if args and args[0] and not args[0].startswith('-'):
+        arg, argv = args[0], args[1:]
     else:
-        arg = DEFAULT
+        arg, argv = DEFAULT, args
 
+    # plugins only get imported for commands that can be affected by them
     cmd = Command.cmds.get(arg)
-    if cmd is None:
+    if cmd is None and arg not in tkt.getplugins.manifest():
         sys.stderr.write("unknown tkt command: %s\n" % arg)
         sys.exit(1)
+    if cmd is None or cmd.plugin_hooks:
+        tkt.getplugins.getplugins()
+        cmd = Command.cmds.get(arg)
     cmd = cmd()
+    cmd.argv = argv
 
     cmd.prepare_options()
 
     try:
-        cmd.main()
+        if rev is not None:
+            tkt.storage.use_revision(rev)
+        cmd.execute()
+    except (tkt.storage.RevisionError, tkt.history.HistoryError), error:
+        cmd.fail(str(error))
     except KeyboardInterrupt:
         cmd.fail("Cancelled")
 
+def run(args, stdin="", forget=True):
+    """run a command in this process, with the plugins already loaded
+
+    stdin is what the command gets to read, and it never sees a tty. returns
+    the exit status along with everything written to stdout and stderr.
+    unless forget is turned off, whatever the project had loaded from the
+    tickets is dropped afterwards, since the command may have changed them.
+    """
+    args, rev = split_revision(args)
+    if args and args[0] and not args[0].startswith('-'):
+        name, argv = args[0], list(args[1:])
+    else:
+        name, argv = DEFAULT, list(args)
+
+    streams = sys.stdin, sys.stdout, sys.stderr
+    sys.stdin = StringIO.StringIO(stdin)
+    sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+    try:
+        try:
+            cls = Command.cmds.get(name)
+            if cls is None:
+                sys.stderr.write("unknown tkt command: %s\n" % name)
+                sys.exit(1)
+
+            cmd = cls()
+            cmd.argv = argv
+
+            # prepare_options fills in the class's own options, only once
+            if not cls.__dict__.get('_options_prepared'):
+                cmd.prepare_options()
+                cls._options_prepared = True
+
+            if rev is not None:
+                tkt.storage.use_revision(rev)
+                tkt.config.project().forget()
+            cmd.execute()
+            status = 0
+        except (tkt.storage.RevisionError, tkt.history.HistoryError), error:
+            sys.stderr.write("%s\n" % error)
+            status = 1
+        except SystemExit, exc:
+            status = exc.code
+            if status is None:
+                status = 0
+            elif not isinstance(status, (int, long)):
+                sys.stderr.write("%s\n" % status)
+                status = 1
+        except KeyboardInterrupt:
+            raise
+        except:
+            traceback.print_exc()
+            status = 1
+
+        return status, sys.stdout.getvalue(), sys.stderr.getvalue()
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = streams
+        if rev is not None:
+            # back to the working tree, and nothing from the revision kept
+            tkt.storage.reload()
+            forget = True
+        if forget:
+            tkt.config.project().forget()
+
 def track_opens():
     builtinopen = __builtins__.open
     globals()['openedfiles'] = opened = []
@@ -66,6 +164,13 @@ def track_opens():
         return builtinopen(name, mode)
     __builtins__.open = opener
 
+AS_OF_OPTION = {
+    'short': '-t',
+    'long': '--as-of',
+    'type': 'string',
+    'help': "as things stood at a time, like 2009-07-13 or '3 days ago'",
+}
+
 def aliases(*names):
     def decorator(cls):
         for name in names:
@@ -102,6 +207,17 @@ class Command(object):
 
     required_data = ["creator"]
 
+    # whether plugins need to be loaded before running the command. only
+    # commands that never touch tickets or the project config can skip them
+    plugin_hooks = True
+
+    # how the command holds the repository lock: shared, exclusive for
+    # structural changes, or None to leave it to the commands it runs
+    lock_repo = tkt.locking.SHARED
+
+    # whether the tickets it gathers get locked, because it writes to them
+    lock_tickets = True
+
     if len(sys.argv) > 1 and sys.argv[1] and not sys.argv[1].startswith('-'):
         argv = sys.argv[2:]
     else:
@@ -113,6 +229,17 @@ class Command(object):
         else:
             self.pipemain()
 
+    def execute(self):
+        "run the command with its locks held and its writes in a transaction"
+        with tkt.locking.session(self.lock_repo):
+            with tkt.files.transaction():
+                try:
+                    self.main()
+                except SystemExit:
+                    self.record_changes()
+                    raise
+                self.record_changes()
+
     def ttymain(self):
         raise NotImplementedError()
 
@@ -140,6 +267,14 @@ class Command(object):
                             user.useremail)
 
     def gather_ticket(self, try_prompting=True, prompt="Ticket:"):
+        issue = self.find_ticket(try_prompting, prompt)
+        if self.lock_tickets and tkt.index.available():
+            # another process may have changed it before we got the lock
+            tkt.locking.lock_ticket(issue.id)
+            issue = self.project.reload_issue(issue.id)
+        return issue
+
+    def find_ticket(self, try_prompting=True, prompt="Ticket:"):
         if not (self.parsed_args and self.parsed_args[0]):
             if try_prompting:
                 tktname = self.prompt(prompt)
@@ -152,24 +287,37 @@ class Command(object):
             tktname = tktname[1:]
 
         if tktname.isdigit():
-            t = int(tktname)
-            if t >= len(self.project.issue_filenames):
-                self.fail("there is no ticket #%d" % t)
-            return self.project._load_issue(t, self.project.issue_filenames[t])
-
-        found = False
-        for index, filename in enumerate(self.project.issue_filenames):
-            if tktname in os.path.abspath(filename).split(os.sep)[-2]:
-                if found:
-                    self.fail("more than one ticket matches '%s'" % tktname)
-                issue = (index, filename)
-                found = True
-        if found:
-            return self.project._load_issue(*issue)
-
-        for issue in self.project.issues:
-            if tktname in issue.valid_names:
-                return issue
+            number = int(tktname)
+            issueids = self.project.issue_ids_numbered(number)
+            if issueids[1:]:
+                self.fail("more than one ticket is #%d: %s, name one by its " %
+                          (number, ", ".join(issueids)) +
+                          "id or give it a new number with 'tkt renumber'")
+            if not issueids:
+                self.fail("there is no ticket #%d" % number)
+            return self.project.load_issue(issueids[0])
+
+        issueids = self.project.issue_ids_like(tktname)
+        if issueids[1:]:
+            self.fail("more than one ticket matches '%s': %s" % (
+                    tktname, ", ".join(issueids[:5])))
+        if issueids:
+            return self.project.load_issue(issueids[0])
+
+        if try_prompting and sys.stdin.isatty():
+            similar = self.project.issues_titled_like(tktname)
+        else:
+            similar = []
+
+        if similar:
+            text = ["No ticket named '%s', did you mean:" % tktname]
+            for i, (issueid, title) in enumerate(similar):
+                text.append("%d) %s" % (i + 1, title))
+            text.append("Select a ticket [Enter for none]:")
+
+            index = self.prompt("\n".join(text))
+            if index.isdigit() and 0 < int(index) <= len(similar):
+                return self.project.load_issue(similar[int(index) - 1][0])
 
         self.fail("no ticket found with name %s" % tktname)
 
@@ -210,6 +358,14 @@ class Command(object):
         sys.stderr.write(message + "\n")
         sys.exit(1)
 
+    def parse_time(self, text):
+        if not text:
+            return None
+        try:
+            return tkt.flextime.parse(text)
+        except ValueError, error:
+            self.fail(str(error))
+
     def require_all_options(self, exceptions=None):
         required = set(o['long'][2:] for o in self.options).difference(
                 exceptions or ())
@@ -221,6 +377,44 @@ class Command(object):
     def project(self):
         return tkt.config.project()
 
+    @property
+    def as_of(self):
+        "the time an --as-of option asks to see the tickets at, if any"
+        return self.parse_time(getattr(self.parsed_options, 'as_of', None))
+
+    def summary(self):
+        """{(value of each of tkt.index.SUMMARY_FIELDS): number of tickets}
+
+        that's kept in the index, so it only takes reading the tickets when
+        it isn't there or is out of date, or when the tickets come from
+        another time or a git revision.
+        """
+        if self.as_of is None and tkt.index.available():
+            index = tkt.index.metadata()
+            if not index.listing_current():
+                index.refresh_listing(self.project.issue_ids)
+            counts = index.summary()
+            if counts is None or \
+                    not index.records_current(self.project.issue_ids):
+                # only the tickets that changed get read again
+                self.project.issues
+                counts = index.summary()
+            return counts
+
+        grouping = tuple(tkt.aggregate.field(name, None)
+                         for name in tkt.index.SUMMARY_FIELDS)
+        return tkt.aggregate.aggregate(self.issues, grouping,
+                                       members=False).counts(grouping)
+
+    @property
+    def issues(self):
+        "the project's tickets, or as they were at the --as-of time"
+        if self.as_of is None:
+            return self.project.issues
+        if '_issues_as_of' not in self.__dict__:
+            self._issues_as_of = self.project.issues_as_of(self.as_of)
+        return self._issues_as_of
+
     def store_new_issue(self, **data):
         dt = datetime.datetime.now()
         utc = tkt.timezones.to_utc(dt)
@@ -230,16 +424,13 @@ class Command(object):
         data['id'] = "%s-%s" % (hextimestamp(utc)[:8], uuid.uuid4().hex[:8])
         data['created'] = dt
 
-        issue = tkt.models.Issue(data)
-
+        # bring the index up to date before a number gets handed out
         issuelist = self.project.issues
-        issuelist.append(issue)
+        data['number'] = self.project.next_number(data['id'])
 
-        issuepath = tkt.files.issue_filename(issue.id)
-        issuedir = os.path.abspath(os.path.join(issuepath, os.pardir))
-
-        if not os.path.exists(issuedir):
-            os.makedirs(issuedir)
+        issue = self.project._init_issue(data['number'],
+                                         tkt.models.Issue(data))
+        issuelist.append(issue)
 
         self.store_issue(issue)
         self.store_new_event(issue, "ticket created", issue.created,
@@ -247,7 +438,11 @@ class Command(object):
 
         return issue
 
-    def store_new_event(self, issue, title, created, creator, comment):
+    def store_new_event(self, issue, title, created, creator, comment,
+                        changes=None):
+        if changes is None:
+            changes = self.take_changes(issue)
+
         utc = tkt.timezones.to_utc(created)
         event = tkt.models.Event({
             'id': "%s-%s" % (hextimestamp(utc)[:8], uuid.uuid4().hex[:8]),
@@ -255,25 +450,74 @@ class Command(object):
             'created': created,
             'creator': creator,
             'comment': comment,
+            'changes': changes or None,
         })
 
         eventlist = issue.events
         eventlist.append(event)
 
-        fp = open(tkt.files.event_filename(issue.id, event.id), 'w')
-        try:
-            event.dump(fp)
-        finally:
-            fp.close()
+        text = event.dump()
+        tkt.storage.backend().write_event(issue.id, event.id, text)
+        tkt.textindex.document_stored(issue.id, event.id, text)
 
         return event
 
     def store_issue(self, issue):
-        fp = open(tkt.files.issue_filename(issue.id), 'w')
-        try:
-            issue.dump(fp)
-        finally:
-            fp.close()
+        storage = tkt.storage.backend()
+        unrecorded = self.__dict__.setdefault('_unrecorded', {})
+
+        if tkt.index.available():
+            # status counts the tickets by their index records, which take
+            # the change once it has been written
+            tkt.files.on_commit(functools.partial(tkt.index.metadata().store,
+                                                  issue.id, issue.state()))
+
+        if not storage.has_issue(issue.id):
+            # a new ticket, its first version is where its history starts
+            pass
+        elif tkt.history.eventsourced():
+            # the ticket file stays as it was, an event records the change
+            unrecorded[issue.id] = (issue, None)
+            return
+        else:
+            changes = tkt.history.diff(tkt.history.issue_data(issue.id),
+                                       issue.state())
+            if issue.id in unrecorded:
+                changes = tkt.history.merge(unrecorded[issue.id][1], changes)
+            unrecorded[issue.id] = (issue, changes)
+
+        text = issue.dump()
+        storage.write_issue(issue.id, text)
+        tkt.textindex.document_stored(issue.id, '', text)
+
+    def take_changes(self, issue):
+        "the stored changes to a ticket that no event has recorded yet"
+        stored, changes = self.__dict__.get('_unrecorded', {}).pop(issue.id,
+                                                                   (None, {}))
+        if stored is not None and tkt.history.eventsourced():
+            changes = tkt.history.diff(tkt.history.issue_data(issue.id),
+                                       issue.state())
+        return changes
+
+    def record_changes(self):
+        "append events for the stored changes that no event has recorded"
+        unrecorded = self.__dict__.get('_unrecorded', {})
+        if not tkt.history.eventsourced():
+            # the ticket files already have them
+            unrecorded.clear()
+            return
+
+        storage = tkt.storage.backend()
+        for issueid, (issue, changes) in sorted(unrecorded.items()):
+            if not storage.has_issue(issueid):
+                # dropped since
+                continue
+            changes = self.take_changes(issue)
+            if changes:
+                self.store_new_event(issue, "ticket updated",
+                        datetime.datetime.now(), self.gather_creator(), "",
+                        changes)
+        unrecorded.clear()
 
     def _build_parser(self):
         parser = optparse.OptionParser()
@@ -377,11 +621,18 @@ class Help(Command):
 
     usageinfo = "explain tkt commands"
 
+    lock_repo = None
+
+    plugin_hooks = False
+
     def main(self):
         if not self.parsed_args:
             print "Commands (use 'tkt help <cmd>' to see more detail)\n"
             print self.list_args()
             sys.exit()
+
+        # plugins can add options to any command
+        tkt.getplugins.getplugins()
         arg = self.parsed_args[0]
         cmd = self.cmds.get(arg)
         if cmd is None:
@@ -392,9 +643,11 @@ class Help(Command):
         cmd._build_parser().print_help()
 
     def list_args(self):
+        # the manifest has the plugins' commands without importing them
         cmds = {}
-        for key, cmd in self.cmds.iteritems():
-            cmds.setdefault(cmd, []).append(key)
+        for key, (module, classname, usageinfo) in \
+                tkt.getplugins.manifest().iteritems():
+            cmds.setdefault((module, classname, usageinfo), []).append(key)
 
         for cmd, names in cmds.items():
             cmds[cmd] = "/".join(sorted(names))
@@ -402,9 +655,9 @@ class Help(Command):
         output = []
         groups = sorted(cmds.iteritems(), key=operator.itemgetter(1))
         longest = max(len(pair[1]) for pair in groups)
-        for cmd, names in groups:
-            if hasattr(cmd, "usageinfo"):
-                output.append(" %s: %s" % (names.rjust(longest), cmd.usageinfo))
+        for (module, classname, usageinfo), names in groups:
+            if usageinfo is not None:
+                output.append(" %s: %s" % (names.rjust(longest), usageinfo))
             else:
                 output.append(names)
 
@@ -419,6 +672,11 @@ class Init(Command):
             'long': '--plugins',
             'help': 'a comma-separated list of python-paths to plugins',
             'type': 'string'
+        },
+        {
+            'short': '-e',
+            'long': '--event-sourced',
+            'help': 'keep ticket state in the events, see tkt help history',
         }
     ]
 
@@ -444,7 +702,10 @@ class Init(Command):
         if not os.path.isdir(datafolder):
             os.makedirs(datafolder)
 
-        project = tkt.models.ProjectConfig({'plugins': self.gather_plugins()})
+        project = tkt.models.ProjectConfig({
+            'plugins': self.gather_plugins(),
+            'eventsourced': self.parsed_options.event_sourced,
+        })
 
         fp = open(projpath, 'w')
         try:
@@ -454,21 +715,50 @@ class Init(Command):
 aliases('setup')(Init)
 
 class Todo(Command):
-    options = [{
-        'short': '-a',
-        'long': '--show-all',
-        'help': 'also show closed tickets',
-    }]
+    options = [
+        {
+            'short': '-a',
+            'long': '--show-all',
+            'help': 'also show closed tickets',
+        },
+        {
+            'short': '-n',
+            'long': '--limit',
+            'type': 'int',
+            'help': 'show at most this many tickets',
+        },
+        {
+            'short': '-o',
+            'long': '--offset',
+            'type': 'int',
+            'default': 0,
+            'help': 'skip this many tickets first',
+        },
+        AS_OF_OPTION,
+    ]
 
     usageinfo = "list tickets"
 
     def main(self):
-        self.display_issues(self.project.issues)
+        self.display_issues(self.issues)
 
     def display_issues(self, issuelist):
-        notclosed = [i for i in issuelist if i.status != CLOSED]
-        issues = self.parsed_options.show_all and issuelist or notclosed
-
+        self.print_issues(self.window(issuelist))
+
+    def window(self, issuelist):
+        "the tickets in the --offset/--limit window, only open ones unless -a"
+        start = self.parsed_options.offset
+        stop = None
+        if self.parsed_options.limit is not None:
+            stop = start + self.parsed_options.limit
+
+        # only the tickets in the window get loaded
+        if self.parsed_options.show_all:
+            return issuelist[start:stop]
+        return list(itertools.islice(
+                (i for i in issuelist if i.status != CLOSED), start, stop))
+
+    def print_issues(self, issues):
         for issue in issues:
             print issue.view_one_line()
 
@@ -481,10 +771,19 @@ class Todo(Command):
 class Show(Command):
     usage = "[<ticket>]"
 
+    options = [AS_OF_OPTION]
+
     usageinfo = "display a ticket in detail"
 
+    lock_tickets = False
+
     def main(self):
-        print self.gather_ticket().view_detail()
+        issue = self.gather_ticket()
+        if self.as_of is not None:
+            issue = self.project.issue_as_of(issue.id, self.as_of)
+            if issue is None:
+                self.fail("the ticket didn't exist yet")
+        print issue.view_detail()
 
 aliases('view')(Show)
 
@@ -647,37 +946,65 @@ class Drop(Command):
 
     usageinfo = "completely purge a ticket from the repository"
 
+    lock_repo = tkt.locking.EXCLUSIVE
+
     def main(self):
         issue = self.gather_ticket()
-        shutil.rmtree(os.path.dirname(tkt.files.issue_filename(issue.id)))
+        tkt.storage.backend().drop_issue(issue.id)
+        tkt.textindex.issue_dropped(issue.id)
+        if tkt.index.available():
+            tkt.index.metadata().drop(issue.id)
 
 aliases('delete')(Drop)
 
+class Renumber(Command):
+    usage = "[<ticket>]"
+
+    usageinfo = "give a ticket a new number, when another has the same one"
+
+    def main(self):
+        issue = self.gather_ticket()
+        oldname = issue.name
+
+        issue.number = self.project.next_number(issue.id)
+        issue.name = "#%d" % issue.number
+
+        self.store_issue(issue)
+        self.store_new_event(issue,
+            "ticket renumbered from %s to %s" % (oldname, issue.name),
+            datetime.datetime.now(),
+            self.gather_creator(),
+            "")
+
 class Status(Command):
+    options = [AS_OF_OPTION]
+
     usageinfo = 'print a rundown of the progress on all tickets'
 
     def main(self):
-        print self.display_status(self.project.issues)
-
-    def display_status(self, issues):
-        tickets = {}
-        for issue in issues:
-            tickets.setdefault(issue.type, []).append(issue)
+        print self.display_status(self.summary())
+
+    def display_status(self, counts):
+        "the rundown of {(type, status): number of tickets}"
+        totals = collections.defaultdict(int)
+        closed = collections.defaultdict(int)
+        chars = collections.defaultdict(int)
+        for (type, status), count in counts.iteritems():
+            totals[type] += count
+            if status == CLOSED:
+                closed[type] += count
+            chars[tkt.models.Issue.status_char(status)] += count
 
         text = []
         types = sorted(tkt.models.Issue.types, key=operator.itemgetter(1))
         for char, type in types:
-            issuegroup = tickets.get(type, [])
-            text.append("%d/%d %s" % (
-                len([i for i in issuegroup if i.status == CLOSED]),
-                len(issuegroup),
-                type))
+            text.append("%d/%d %s" % (closed[type], totals[type], type))
 
-        issuechars = [issue.view_one_char() for issue in issues]
         self.charoptions = [s[0] for s in tkt.models.Issue.statuses]
-        issuechars.sort(key=self.issuecharkeyfunc)
+        issuechars = "".join(char * chars[char] for char in
+                             sorted(chars, key=self.issuecharkeyfunc))
 
-        return "%s  %s" % (",  ".join(text), "".join(issuechars))
+        return "%s  %s" % (",  ".join(text), issuechars)
 
     def issuecharkeyfunc(self, s):
         if s in self.charoptions:
@@ -689,7 +1016,7 @@ class Edit(Command):
 
     usageinfo = "edit the ticket data directly with your text editor"
 
-    uneditable_fields = ["id"]
+    uneditable_fields = ["id", "number"]
 
     def validate_title(self, title):
         return isinstance(title, basestring)
@@ -734,7 +1061,7 @@ class Edit(Command):
         return status in [p[1] for p in tkt.models.Issue.statuses]
 
     def main(self):
-        issue = self.gather_ticket()
+        issue = self.issue = self.gather_ticket()
 
         data = dict(zip(issue.fields, map(functools.partial(getattr, issue),
                                           issue.fields)))
@@ -850,26 +1177,66 @@ class Grep(Command):
         if not (self.parsed_args and self.parsed_args[0]):
             self.fail("a regular expression argument required")
 
-        dirname = tkt.config.datapath()
-        args = ["grep", "-E", self.parsed_args[0]]
-        args.extend(glob.glob("%s%stickets%s*%s*.yaml" %
-                (dirname, os.sep, os.sep, os.sep)))
+        try:
+            regex = re.compile(self.parsed_args[0], re.M)
+        except re.error, error:
+            self.fail("bad regular expression: %s" % error)
+
+        if tkt.index.available():
+            matches = self.grep_index(regex)
+        elif tkt.storage.backend().name == tkt.storage.FileStorage.name:
+            matches = self.grep_files(regex)
+        else:
+            matches = self.grep_storage(regex)
 
-        proc = subprocess.Popen(args, stdout=subprocess.PIPE)
-        output = proc.communicate()[0]
+        for issueid in sorted(matches):
+            print self.project.load_issue(issueid).view_one_line()
 
-        matches = map(self.path_regex.search, output.splitlines())
-        matches = set(match.groups()[0] for match in matches if match)
+        if not matches:
+            print "no matches found"
 
-        #TODO: load only the ones we need
-        foundone = False
-        for issue in self.project.issues:
-            if issue.id in matches:
-                foundone = True
-                print issue.view_one_line()
+    def grep_index(self, regex):
+        # the first grep pays for building the index, like search --text
+        index = tkt.textindex.trigrams()
+        if index.built:
+            index.refresh()
+        else:
+            index.build()
 
-        if not foundone:
-            print "no matches found"
+        storage = tkt.storage.backend()
+        matches = set()
+        for issueid, eventid in index.candidates(regex.pattern):
+            if issueid in matches:
+                continue
+            if eventid:
+                text = storage.read_event(issueid, eventid)
+            else:
+                text = storage.read_issue(issueid)
+            if regex.search(text):
+                matches.add(issueid)
+        return matches
+
+    def grep_files(self, regex):
+        dirname = tkt.config.datapath()
+        paths = glob.glob("%s%stickets%s*%s*.yaml" %
+                (dirname, os.sep, os.sep, os.sep))
+
+        matches = map(self.path_regex.search,
+                      tkt.scan.scan(regex.pattern, paths, regex.flags))
+        return set(match.groups()[0] for match in matches if match)
+
+    def grep_storage(self, regex):
+        storage = tkt.storage.backend()
+        matches = set()
+        for issueid in storage.issue_ids():
+            if regex.search(storage.read_issue(issueid)):
+                matches.add(issueid)
+                continue
+            for eventid in storage.event_ids(issueid):
+                if regex.search(storage.read_event(issueid, eventid)):
+                    matches.add(issueid)
+                    break
+        return matches
 
 class Search(Command):
     usageinfo = "search for tickets by field/value"
@@ -917,6 +1284,32 @@ class Search(Command):
             'type': 'string',
             'help': 'a portion of the ticket description',
         },
+        {
+            'short': '-x',
+            'long': '--text',
+            'type': 'string',
+            'help': 'words to look for in titles, descriptions and ' +
+                    'comments, best matches first',
+        },
+        {
+            'short': '-k',
+            'long': '--limit',
+            'type': 'int',
+            'default': 10,
+            'help': 'the most tickets to show for --text (default 10)',
+        },
+        {
+            'short': '-A',
+            'long': '--created-after',
+            'type': 'string',
+            'help': "tickets created since a date or a time ago ('1 week')",
+        },
+        {
+            'short': '-B',
+            'long': '--created-before',
+            'type': 'string',
+            'help': 'tickets created before a date or a time ago',
+        },
     ]
 
     def prepare_options(self):
@@ -986,11 +1379,40 @@ class Search(Command):
     def run_all_filters(self, issue):
         return all(getattr(self, "filter_%s" % f)(issue) for f in self.filters)
 
+    def ranked_issues(self, issueids=None):
+        index = tkt.textindex.ranked()
+        if index.built:
+            index.refresh()
+        else:
+            index.build()
+
+        for issueid, score in index.search(self.parsed_options.text):
+            if issueids is None or issueid in issueids:
+                yield self.project.load_issue(issueid)
+
     def main(self):
-        if not any(getattr(self.parsed_options, i, 0) for i in self.filters):
-            self.fail("at least one of the filtering options is required")
+        after = self.parse_time(self.parsed_options.created_after)
+        before = self.parse_time(self.parsed_options.created_before)
+        windowed = after is not None or before is not None
+
+        if self.parsed_options.text:
+            issueids = None
+            if windowed:
+                issueids = set(self.project.issue_ids_created(after, before))
+            issues = itertools.ifilter(self.run_all_filters,
+                                       self.ranked_issues(issueids))
+            issues = itertools.islice(issues, self.parsed_options.limit)
+        else:
+            if not windowed and not any(getattr(self.parsed_options, i, 0)
+                                        for i in self.filters):
+                self.fail("at least one of the filtering options is required")
+
+            if windowed:
+                issues = self.project.issues_created(after, before)
+            else:
+                issues = self.project.issues
+            issues = itertools.ifilter(self.run_all_filters, issues)
 
-        issues = itertools.ifilter(self.run_all_filters, self.project.issues)
         at_least_one = False
 
         for issue in issues:
@@ -1005,22 +1427,69 @@ aliases('find')(Search)
 class Log(Command):
     usage = "[<ticket>]"
 
+    options = [
+        {
+            'short': '-s',
+            'long': '--since',
+            'type': 'string',
+            'help': "only events since a date or a time ago ('2 weeks')",
+        },
+        {
+            'short': '-u',
+            'long': '--until',
+            'type': 'string',
+            'help': "only events until a date or a time ago",
+        },
+        {
+            'short': '-n',
+            'long': '--count',
+            'type': 'int',
+            'help': 'only the most recent this many events',
+        },
+    ]
+
     usageinfo = "short form of recent activity"
 
+    lock_tickets = False
+
+    def event_streams(self, issueids, since, until):
+        "per ticket, the (event id, ticket id) pairs in the window, in order"
+        # event ids start with the hex creation timestamp, so the window can
+        # be cut out of each ticket's sorted ids without reading any events
+        if until is not None:
+            until += datetime.timedelta(0, 1)
+
+        storage = tkt.storage.backend()
+        for issueid in issueids:
+            eventids = tkt.models.ids_created(storage.event_ids(issueid),
+                                              since, until)
+            if eventids:
+                yield itertools.izip(eventids, itertools.repeat(issueid))
+
+    def load_events(self, pairs):
+        issues = {}
+        for eventid, issueid in pairs:
+            if issueid not in issues:
+                issues[issueid] = self.project.load_issue(issueid)
+            yield issues[issueid]._load_event(eventid)
+
     def main(self):
+        since = self.parse_time(self.parsed_options.since)
+        until = self.parse_time(self.parsed_options.until)
+
         if self.parsed_args:
-            tktname = self.parsed_args[0]
-            for issue in self.project.issues:
-                if tktname in issue.valid_names:
-                    events = issue.events
-                    break
-            else:
-                self.fail("no ticket found with name %s" % tktname)
+            issueids = [self.gather_ticket().id]
+        else:
+            issueids = self.project.issue_ids
+
+        streams = self.event_streams(issueids, since, until)
+        if self.parsed_options.count is not None:
+            pairs = heapq.nlargest(self.parsed_options.count,
+                                   itertools.chain(*streams))
+            pairs.reverse()
         else:
-            events = []
-            for issue in self.project.issues:
-                events.extend(issue.events)
-            events.sort()
+            pairs = heapq.merge(*streams)
+        events = list(self.load_events(pairs))
 
         if not events:
             print "nothing to report"
@@ -1054,6 +1523,8 @@ aliases('shortlog')(Log)
 class ImportDitz(Command):
     usageinfo = "start your new repository from the current ditz repo"
 
+    lock_repo = tkt.locking.EXCLUSIVE
+
     def main(self):
         import tkt.fromditz
 
@@ -1070,6 +1541,7 @@ class ImportDitz(Command):
         finally:
             fp.close()
 
+        tkt.config.reload(reread=True)
         tkt.getplugins.getplugins()
 
         tkt.fromditz.main()
@@ -1081,6 +1553,8 @@ class Upgrade(Command):
 
     usage = "<version>"
 
+    lock_repo = tkt.locking.EXCLUSIVE
+
     def gather_upgrader(self):
         if not (self.parsed_args and self.parsed_args[0]):
             self.fail("a version is required")
@@ -1170,12 +1644,365 @@ class Upgrade(Command):
             newfile = os.path.join(os.path.dirname(oldfile), "ticket.yaml")
             shutil.mv(oldfile, newfile)
 
+    def point_five_upgrade(self):
+        # write the positional numbers into the tickets so they stay put
+        for number, issueid in enumerate(self.project.issue_ids):
+            issue = self.project._load_issue(number, issueid)
+            if issue.number is None:
+                issue.number = number
+                self.store_issue(issue)
+
     upgrades = {
         '0.3': point_three_upgrade,
         '0.4': point_four_upgrade,
+        '0.5': point_five_upgrade,
     }
 
     def main(self):
         upgrader = self.gather_upgrader()
 
         upgrader(self)
+
+class Reindex(Command):
+    usageinfo = "build or rebuild the indexes behind grep and search --text"
+
+    plugin_hooks = False
+
+    def main(self):
+        tkt.textindex.trigrams().build()
+        tkt.textindex.ranked().build()
+
+class Recount(Command):
+    usageinfo = "check the ticket counts behind status and fix them"
+
+    lock_repo = tkt.locking.EXCLUSIVE
+
+    def main(self):
+        if not tkt.index.available():
+            self.fail("there is no index to check")
+        index = tkt.index.metadata()
+        counted = index.summary() or {}
+
+        # reading every ticket catches the index up with them, then the
+        # counts start over from the records
+        self.project.issues
+        index.recount()
+        actual = index.summary()
+
+        wrong = 0
+        for key in sorted(set(counted) | set(actual)):
+            if counted.get(key, 0) != actual.get(key, 0):
+                print "%s: counted %d, there are %d" % (
+                        " / ".join(str(value) for value in key),
+                        counted.get(key, 0), actual.get(key, 0))
+                wrong += 1
+
+        if wrong:
+            print "fixed %d count(s)" % wrong
+        else:
+            print "the counts are right"
+
+class Convert(Command):
+    usageinfo = "move the ticket data to a different storage backend"
+
+    lock_repo = tkt.locking.EXCLUSIVE
+
+    usage = "<%s>"
+
+    def prepare_options(self):
+        self.usage %= "|".join(sorted(tkt.storage.backends))
+
+    def main(self):
+        if not (self.parsed_args and self.parsed_args[0]):
+            self.fail("a storage backend is required")
+        name = self.parsed_args[0]
+
+        if name not in tkt.storage.backends:
+            self.fail("storage backends are %s" %
+                      ", ".join(sorted(tkt.storage.backends)))
+
+        source = tkt.storage.backend()
+        if source.name == name:
+            self.fail("the tickets are already stored as '%s'" % name)
+
+        tkt.storage.convert(source, tkt.storage.backends[name]())
+
+        self.project.storage = name
+        tkt.files.write(tkt.files.project_filename(), self.project.dump())
+
+        # the old copy only goes once the new one is down for good
+        tkt.files.on_commit(source.destroy)
+
+class History(Command):
+    usage = "<events|snapshots>"
+
+    usageinfo = "keep ticket state in the events or rewrite ticket.yaml"
+
+    lock_repo = tkt.locking.EXCLUSIVE
+
+    modes = {'events': True, 'snapshots': False}
+
+    def main(self):
+        if not (self.parsed_args and self.parsed_args[0] in self.modes):
+            self.fail("the modes are %s" % ", ".join(sorted(self.modes)))
+        name = self.parsed_args[0]
+        eventsourced = self.modes[name]
+
+        if eventsourced == self.project.eventsourced:
+            self.fail("ticket state is already kept as %s" % name)
+
+        storage = tkt.storage.backend()
+        for issueid in self.project.issue_ids:
+            current = yaml.load(storage.read_issue(issueid))
+
+            if not eventsourced:
+                replayed = tkt.history.replay(issueid)
+                if replayed != current:
+                    text = yaml.dump(replayed, default_flow_style=False)
+                    storage.write_issue(issueid, text)
+                    tkt.textindex.document_stored(issueid, '', text)
+                continue
+
+            # the ticket file goes back to how the ticket started out, with
+            # the changes the events recorded undone
+            events = tkt.history.events(issueid)
+            first = tkt.history._first_state(issueid, events)
+            replayed = copy.deepcopy(first)
+            for event in events:
+                tkt.history.apply(replayed, event.get('changes'))
+
+            # older events didn't record their changes (and the file may
+            # have been edited by hand), so one more event may have to bring
+            # the replayed state up to the ticket file's
+            changes = tkt.history.diff(replayed, current)
+            if changes:
+                self.store_new_event(self.project.load_issue(issueid),
+                        "ticket updated", datetime.datetime.now(),
+                        self.gather_creator(), "", changes)
+
+            if first != current:
+                text = yaml.dump(first, default_flow_style=False)
+                storage.write_issue(issueid, text)
+                tkt.textindex.document_stored(issueid, '', text)
+
+        # they were taken going by the old mode
+        tkt.index.metadata().drop_checkpoints()
+
+        # in the same commit as the tickets, the mode has to match them
+        self.project.eventsourced = eventsourced
+        tkt.files.write(tkt.files.project_filename(), self.project.dump())
+
+class Sync(Command):
+    options = [
+        {
+            'short': '-m',
+            'long': '--mine',
+            'help': 'settle conflicting ticket edits with the ones here',
+        },
+        {
+            'short': '-t',
+            'long': '--theirs',
+            'help': 'settle conflicting ticket edits with the other side\'s',
+        },
+        {
+            'short': '-r',
+            'long': '--rehash',
+            'help': 'hash every ticket again instead of trusting the ' +
+                    'cache, after editing tickets without tkt',
+        },
+    ]
+
+    usage = "<path>"
+
+    usageinfo = "exchange new tickets and events with another copy"
+
+    lock_repo = tkt.locking.EXCLUSIVE
+
+    def gather_datapath(self):
+        if not (self.parsed_args and self.parsed_args[0]):
+            self.fail("the path of the other copy is required")
+        path = os.path.abspath(os.path.expanduser(self.parsed_args[0]))
+
+        # either the project folder or its data folder will do
+        if os.path.basename(path) != tkt.config.DATAFOLDERNAME:
+            path = os.path.join(path, tkt.config.DATAFOLDERNAME)
+        if not os.path.isfile(os.path.join(path,
+                tkt.models.ProjectConfig.RCFILENAME)):
+            self.fail("no tkt repository at %s" % self.parsed_args[0])
+        if os.path.samefile(path, tkt.config.datapath()):
+            self.fail("that's this repository")
+        return path
+
+    def main(self):
+        options = self.parsed_options
+        if options.mine and options.theirs:
+            self.fail("only one of --mine and --theirs makes sense")
+
+        datapath = self.gather_datapath()
+        fp = open(os.path.join(datapath, tkt.models.ProjectConfig.RCFILENAME))
+        try:
+            other = tkt.models.ProjectConfig.fromdata(yaml.load(fp) or {})
+        finally:
+            fp.close()
+        if self.project.storage != 'files' or other.storage != 'files':
+            self.fail("only tickets stored as 'files' can be synced")
+
+        if not tkt.locking.lock_project(datapath):
+            self.fail("the other copy is busy, try again later")
+
+        here = tkt.sync.HashTree(tkt.config.datapath(), options.rehash)
+        there = tkt.sync.HashTree(datapath, options.rehash)
+        prefer = options.mine and 'here' or options.theirs and 'there' or None
+        plan = tkt.sync.Plan(here, there, prefer)
+        plan.run()
+
+        pulled = len([c for c in plan.copies if c[1] is here])
+        if pulled and tkt.index.available():
+            # edits came in that the status counts haven't seen
+            tkt.index.metadata().summary_stale()
+        if len(plan.copies) > pulled:
+            # and the other copy's counts haven't seen what went there
+            tkt.index.summary_stale(datapath)
+        print "%d files copied here, %d copied there" % (
+                pulled, len(plan.copies) - pulled)
+
+        text = []
+        if plan.conflicts:
+            text.append(
+                    "conflicting edits, settle them with --mine or --theirs:")
+            for issueid in plan.conflicts:
+                title = (yaml.load(here.read(issueid,
+                        tkt.sync.ISSUEFILENAME)) or {}).get('title')
+                text.append("  %s %s" % (issueid[:8], title))
+
+        clashes = plan.number_clashes()
+        if clashes:
+            text.append("new tickets on both sides got the same numbers, " +
+                        "give one of each a new one with 'tkt renumber <id>':")
+            for number, ours, theirs in clashes:
+                text.append("  #%d: %s" % (number, ", ".join(ours + theirs)))
+
+        if text:
+            self.fail("\n".join(text))
+
+class Batch(Command):
+    options = [{
+        'short': '-g',
+        'long': '--group',
+        'type': 'int',
+        'default': 100,
+        'help': 'the most commands to commit to disk together (default 100)',
+    }]
+
+    usageinfo = "run commands read from stdin, one per line, in one process"
+
+    lock_repo = None
+
+    def parse_line(self, line):
+        "the arguments and stdin for a line of shell-style words or json"
+        if not (line.startswith('[') or line.startswith('{')):
+            return shlex.split(line), ""
+
+        request = json.loads(line)
+        if isinstance(request, list):
+            request = {'args': request}
+        return ([unicode(arg).encode('utf-8') for arg in request.get('args', [])],
+                unicode(request.get('stdin', u'')).encode('utf-8'))
+
+    def input_waiting(self):
+        return bool(select.select([sys.stdin], [], [], 0)[0])
+
+    def lock_mode(self, args):
+        "how the command on a line holds the repository lock"
+        args = split_revision(args)[0]
+        if args and args[0] and not args[0].startswith('-'):
+            name = args[0]
+        else:
+            name = DEFAULT
+        cls = Command.cmds.get(name)
+        return cls and cls.lock_repo
+
+    def join_group(self, mode, results):
+        """have the group's session hold the repository lock as needed
+
+        when the session holds it some other way, the group is committed
+        and a new one started.
+        """
+        if mode is None or (self.group and
+                            self.group[0] in (mode, tkt.locking.EXCLUSIVE)):
+            return
+        self.commit(results)
+
+        session = tkt.locking.session(mode, self.flush)
+        session.__enter__()
+        self.group = mode, session
+
+    def flush(self):
+        self.transaction.commit()
+
+    def commit(self, results):
+        "make the writes behind the results durable, then report them"
+        # group commit: everything since the last one shares a single commit
+        self.transaction.commit()
+
+        # the group's locks are held until its writes are down
+        if self.group:
+            self.group[1].__exit__(None, None, None)
+            self.group = None
+
+        for result in results:
+            sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+        results[:] = []
+
+    def main(self):
+        self.transaction = tkt.files.current()
+        self.group = None
+        results = []
+        number = 0
+        try:
+            for line in iter(sys.stdin.readline, ''):
+                number += 1
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    results.append(self.perform(number, line, results))
+
+                if results and (len(results) >= self.parsed_options.group or
+                                not self.input_waiting()):
+                    self.commit(results)
+
+            self.commit(results)
+        finally:
+            if self.group:
+                self.group[1].__exit__(None, None, None)
+
+    def perform(self, number, line, results):
+        result = {'line': number}
+        try:
+            args, stdin = self.parse_line(line)
+        except ValueError, error:
+            result.update(status=1, output="", errors="%s\n" % error)
+            return result
+
+        if args and Command.cmds.get(args[0]) is Batch:
+            result.update(args=args, status=1, output="",
+                          errors="batches can't be nested\n")
+            return result
+
+        # the commands of a group share its locks until it's committed
+        self.join_group(self.lock_mode(args), results)
+        status, output, errors = run(args, stdin)
+        result.update(args=args, status=status, output=output, errors=errors)
+        return result
+
+class Serve(Command):
+    usageinfo = "keep the project loaded and answer queries from other tkts"
+
+    lock_repo = None
+
+    def main(self):
+        import tkt.daemon
+        try:
+            tkt.daemon.serve()
+        except tkt.daemon.AlreadyRunning:
+            self.fail("a tkt server is already running for this project")
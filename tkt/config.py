@@ -1,3 +1,4 @@
+import copy
 import os
 
 import tkt.models
@@ -6,13 +7,26 @@ import yaml
 
 DATAFOLDERNAME = '.tkt'
 
+def _configdata(name, cls):
+    "the path and parsed contents of a config file, read once per process"
+    key = '_%sdata' % name
+    if key not in globals():
+        path, exists = cls.findpath()
+        data = {}
+        if exists:
+            fp = open(path)
+            try:
+                data = yaml.load(fp) or {}
+            finally:
+                fp.close()
+        globals()[key] = path, data
+
+    return globals()[key]
+
 def user():
     if '_user' not in globals():
-        path, exists = tkt.models.UserConfig.findpath()
-        if exists:
-            user = tkt.models.UserConfig.loadfile(path)
-        else:
-            user = tkt.models.UserConfig({})
+        path, data = _configdata('user', tkt.models.UserConfig)
+        user = tkt.models.UserConfig.fromdata(copy.deepcopy(data))
         user.filepath = path
         globals()['_user'] = user
 
@@ -20,15 +34,24 @@ def user():
 
 def project():
     if '_project' not in globals():
-        path, exists = tkt.models.ProjectConfig.findpath()
-        if exists:
-            project = tkt.models.ProjectConfig.loadfile(path)
-        else:
-            project = tkt.models.ProjectConfig({})
+        path, data = _configdata('project', tkt.models.ProjectConfig)
+        project = tkt.models.ProjectConfig.fromdata(copy.deepcopy(data))
         project.filepath = path
         globals()['_project'] = project
 
     return globals()['_project']
 
+def reload(reread=False):
+    """rebuild the config objects the next time they're asked for
+
+    plugins can swap in their own config classes, so the objects get rebuilt
+    after loading them. that reuses the parsed files unless reread is set.
+    """
+    names = ['_user', '_project']
+    if reread:
+        names.extend(['_userdata', '_projectdata'])
+    for name in names:
+        globals().pop(name, None)
+
 def datapath():
     return os.path.dirname(project().filepath)
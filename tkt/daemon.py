@@ -0,0 +1,223 @@
+"""a long-running tkt process answering queries over a unix socket
+
+the client half is used by scripts/tkt before anything else gets imported,
+so it sticks to the standard library and finds the project on its own.
+"""
+import errno
+import json
+import os
+import signal
+import socket
+import sys
+
+
+DATAFOLDERNAME = '.tkt' # tkt.config.DATAFOLDERNAME, without importing it
+SOCKETPATH = ('cache', 'daemon.sock')
+
+TICKETS = 'tickets'
+
+# what writing tickets (in the index) or the project touches, the names
+# tkt.index and the storage backends use
+QUICKSCAN = [(SOCKETPATH[0], 'index.db'), ('project.yaml',), (TICKETS,),
+             ('packed', 'offsets')]
+
+# the commands that only read, and so can be answered by the server, mapped
+# to whether they need an argument (or would otherwise prompt for one)
+QUERIES = {
+    'todo': False,
+    'show': True,
+    'view': True,
+    'search': False,
+    'find': False,
+    'log': False,
+    'shortlog': False,
+}
+
+class AlreadyRunning(Exception):
+    pass
+
+def socketpath():
+    "the socket of the project around the working directory, or None"
+    here = os.path.abspath('.')
+    while 1:
+        datapath = os.path.join(here, DATAFOLDERNAME)
+        if os.path.isfile(os.path.join(datapath, 'project.yaml')):
+            return os.path.join(datapath, *SOCKETPATH)
+
+        parent = os.path.dirname(here)
+        if parent == here:
+            return None
+        here = parent
+
+def _recv_all(sock):
+    chunks = []
+    while 1:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return "".join(chunks)
+        chunks.append(chunk)
+
+def request(path, args, stdin=""):
+    "send a command to the server, and return its (status, output, errors)"
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({'args': args, 'stdin': stdin}) + "\n")
+        sock.shutdown(socket.SHUT_WR)
+        response = json.loads(_recv_all(sock))
+    finally:
+        sock.close()
+    return response['status'], response['output'], response['errors']
+
+def client_main():
+    "answer the command line through a running server, if there is one"
+    args = sys.argv[1:]
+    if not args or args[0].startswith('-'):
+        name = 'todo'
+    else:
+        name = args[0]
+
+    if name not in QUERIES or (QUERIES[name] and len(args) < 2):
+        return
+    path = socketpath()
+    if path is None or not os.path.exists(path):
+        return
+
+    try:
+        status, output, errors = request(path, args)
+    except (socket.error, ValueError, KeyError):
+        return # no usable server, run it here instead
+
+    sys.stdout.write(output.encode('utf-8'))
+    sys.stderr.write(errors.encode('utf-8'))
+    sys.exit(status)
+
+class Watcher(object):
+    """tells when the tickets changed since it last looked
+
+    that takes a few stats per query: tkt writes to the index whenever it
+    writes tickets, and adding or removing tickets, storing them packed or
+    changing project.yaml shows in the data folder's own stats. only when
+    one of those moved do the ticket folders get looked at, to tell the
+    server's own index updates from anybody else's writes.
+
+    a ticket file edited by hand in place (rather than replaced) goes
+    unnoticed until one of those changes too.
+    """
+
+    def __init__(self, datapath):
+        self.datapath = datapath
+        self.signature = self.quick_scan()
+        self.folders = self.scan()
+
+    def _stat(self, *parts):
+        try:
+            stat = os.stat(os.path.join(self.datapath, *parts))
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def quick_scan(self):
+        return [self._stat(*parts) for parts in QUICKSCAN]
+
+    def scan(self):
+        "the stats of the ticket folders, which move when a file is replaced"
+        try:
+            names = sorted(os.listdir(os.path.join(self.datapath, TICKETS)))
+        except OSError:
+            return None
+        return hash(tuple((name, self._stat(TICKETS, name))
+                          for name in names))
+
+    def changed(self):
+        signature = self.quick_scan()
+        if signature == self.signature:
+            return False
+        # the index alone could have been the server's own update
+        others = signature[1:] != self.signature[1:]
+        self.signature = signature
+
+        folders = self.scan()
+        if folders == self.folders and not others:
+            return False
+        self.folders = folders
+        return True
+
+def _reload():
+    import tkt.config
+    import tkt.getplugins
+    import tkt.storage
+
+    tkt.config.reload(reread=True)
+    tkt.storage.reload()
+    tkt.getplugins.getplugins()
+
+def _listen(path):
+    if os.path.exists(path):
+        try:
+            request(path, ['help'])
+        except socket.error:
+            os.remove(path) # left behind by a server that died
+        else:
+            raise AlreadyRunning()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(16)
+    return sock
+
+def _handle(conn, watcher):
+    import tkt.commands
+
+    try:
+        data = json.loads(_recv_all(conn))
+        args = [unicode(arg).encode('utf-8') for arg in data['args']]
+        stdin = unicode(data.get('stdin', u'')).encode('utf-8')
+    except (ValueError, KeyError, TypeError):
+        return
+
+    # checked for every query, so one right after a change still sees it
+    if watcher.changed():
+        _reload()
+
+    name = args and not args[0].startswith('-') and args[0] or 'todo'
+    if name in QUERIES or name == 'help':
+        status, output, errors = tkt.commands.run(args, stdin, forget=False)
+    else:
+        status, output, errors = 1, "", "not a query: %s\n" % name
+
+    conn.sendall(json.dumps({'status': status,
+                             'output': output.decode('utf-8', 'replace'),
+                             'errors': errors.decode('utf-8', 'replace')}))
+
+def serve():
+    "answer queries until interrupted, with the project kept loaded"
+    import tkt.config
+    import tkt.index
+
+    path = tkt.index.cachepath(*SOCKETPATH[1:])
+    watcher = Watcher(tkt.config.datapath())
+    sock = _listen(path)
+
+    # so the finally below gets to clean up the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while 1:
+            try:
+                conn, address = sock.accept()
+            except socket.error, error:
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            try:
+                _handle(conn, watcher)
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        if os.path.exists(path):
+            os.remove(path)
@@ -1,4 +1,6 @@
+import contextlib
 import os
+import tempfile
 
 import tkt.config
 
@@ -19,3 +21,192 @@ def event_filename(issueid, eventid):
             "tickets",
             issueid,
             "%s.yaml" % eventid)
+
+def _fsync(path, flags=os.O_RDONLY):
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Transaction(object):
+    """a group of file writes that land together
+
+    every write goes to a temp file beside its target right away, and
+    committing renames them all into place: each file is always either its
+    old or its new version, never half-written. the data gets flushed just
+    before the renames, and each directory touched is synced once per commit
+    rather than once per file. a transaction opened inside another one hands
+    its writes to the outer one when it commits, so they all share its
+    commit.
+
+    functions passed to on_commit get called once the writes are in place,
+    and never if they're thrown away.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.pending = {} # target path: (temp path, text)
+        self.order = []
+        self.dirs = set()
+        self.committed = []
+
+    def write(self, path, text):
+        dirname = os.path.dirname(path)
+        self._makedirs(dirname)
+
+        fd, temp = tempfile.mkstemp(prefix=".%s." % os.path.basename(path),
+                                    suffix=".tmp", dir=dirname)
+        fp = os.fdopen(fd, 'w')
+        try:
+            fp.write(text)
+        finally:
+            fp.close()
+
+        self._replace(path, temp, text)
+
+    def _makedirs(self, dirname):
+        created = []
+        while not os.path.isdir(dirname):
+            created.append(dirname)
+            dirname = os.path.dirname(dirname)
+        for dirname in reversed(created):
+            os.mkdir(dirname)
+            # the new directory's entry has to be synced in its parent
+            self.dirs.add(os.path.dirname(dirname))
+
+    def _replace(self, path, temp, text):
+        if path in self.pending:
+            os.remove(self.pending[path][0])
+        else:
+            self.order.append(path)
+        self.pending[path] = (temp, text)
+
+    def get(self, path):
+        "the text waiting to be written to path, or None"
+        txn = self
+        while txn is not None:
+            if path in txn.pending:
+                return txn.pending[path][1]
+            txn = txn.parent
+        return None
+
+    def paths(self):
+        "every path with a write waiting in this or an enclosing transaction"
+        paths = set(self.pending)
+        if self.parent is not None:
+            paths.update(self.parent.paths())
+        return paths
+
+    def discard(self, dirname):
+        "forget the waiting writes to anything in a directory"
+        prefix = os.path.join(dirname, "")
+        for path in [p for p in self.order if p.startswith(prefix)]:
+            os.remove(self.pending.pop(path)[0])
+            self.order.remove(path)
+        if self.parent is not None:
+            self.parent.discard(dirname)
+
+    def on_commit(self, func):
+        self.committed.append(func)
+
+    def commit(self):
+        committed = self.committed
+        if self.parent is not None:
+            for path in self.order:
+                temp, text = self.pending[path]
+                self.parent._replace(path, temp, text)
+            self.parent.dirs.update(self.dirs)
+            self.parent.committed.extend(committed)
+            committed = []
+        else:
+            for path in self.order:
+                _fsync(self.pending[path][0])
+            for path in self.order:
+                os.rename(self.pending[path][0], path)
+                self.dirs.add(os.path.dirname(path))
+            for dirname in sorted(self.dirs):
+                _fsync(dirname)
+
+        self.pending, self.order, self.dirs = {}, [], set()
+        self.committed = []
+        for func in committed:
+            func()
+
+    def abort(self):
+        for path in self.order:
+            try:
+                os.remove(self.pending[path][0])
+            except OSError:
+                pass
+        self.pending, self.order, self.dirs = {}, [], set()
+        self.committed = []
+
+def current():
+    return globals().get('_transaction')
+
+@contextlib.contextmanager
+def transaction():
+    """group the file writes made inside into one commit
+
+    leaving with an exception throws the writes away, except for SystemExit
+    which is how commands normally finish, failed or not.
+    """
+    parent = current()
+    txn = Transaction(parent)
+    globals()['_transaction'] = txn
+    try:
+        try:
+            yield txn
+        except SystemExit:
+            txn.commit()
+            raise
+        except:
+            txn.abort()
+            raise
+        txn.commit()
+    finally:
+        globals()['_transaction'] = parent
+
+def write(path, text):
+    "write a file atomically, as part of the current transaction if any"
+    txn = current()
+    if txn is not None:
+        txn.write(path, text)
+        return
+
+    with transaction() as txn:
+        txn.write(path, text)
+
+def pending(path):
+    "the text a transaction is about to write to path, or None"
+    txn = current()
+    return txn and txn.get(path)
+
+def pending_paths():
+    txn = current()
+    return txn and txn.paths() or set()
+
+def read(path):
+    text = pending(path)
+    if text is not None:
+        return text
+
+    fp = open(path)
+    try:
+        return fp.read()
+    finally:
+        fp.close()
+
+def discard(dirname):
+    txn = current()
+    if txn is not None:
+        txn.discard(dirname)
+
+def on_commit(func):
+    "call func once the current transaction's writes are down, now if none"
+    txn = current()
+    if txn is None:
+        func()
+    else:
+        txn.on_commit(func)
@@ -1,4 +1,5 @@
 import datetime
+import re
 
 # cutoffs
 _twomin = datetime.timedelta(0, 120)
@@ -7,6 +8,17 @@ _twodays = datetime.timedelta(2)
 _twoweeks = datetime.timedelta(14)
 _sevenweeks = datetime.timedelta(49)
 
+_spans = {
+    'minute': datetime.timedelta(0, 60),
+    'hour': datetime.timedelta(0, 3600),
+    'day': datetime.timedelta(1),
+    'week': datetime.timedelta(7),
+    'month': datetime.timedelta(30),
+    'year': datetime.timedelta(365),
+}
+_span_regex = re.compile(r"^(\d+)\s*(minute|hour|day|week|month|year)s?(\s+ago)?$")
+_formats = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+
 def since(fromtime):
     now = datetime.datetime.now()
     diff = now - fromtime
@@ -33,3 +45,20 @@ def since(fromtime):
 
     return "%d years" % (
             now.year - fromtime.year - (fromtime.month > now.month))
+
+def parse(text):
+    "a local datetime from a date like 2009-07-13 or a time ago like '3 days'"
+    text = " ".join(text.lower().split())
+
+    match = _span_regex.match(text)
+    if match:
+        return datetime.datetime.now() - \
+                int(match.group(1)) * _spans[match.group(2)]
+
+    for format in _formats:
+        try:
+            return datetime.datetime.strptime(text, format)
+        except ValueError:
+            pass
+
+    raise ValueError("unrecognized time: %s" % text)
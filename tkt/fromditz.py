@@ -10,6 +10,7 @@ import uuid
 import tkt.config
 import tkt.files
 import tkt.models
+import tkt.storage
 import tkt.timezones
 import yaml
 
@@ -178,21 +179,12 @@ def main():
 
         issues.append(issue)
 
+    storage = tkt.storage.backend()
     for issue in issues:
-        os.mkdir(os.path.dirname(tkt.files.issue_filename(issue.id)))
-
         for ev in events[issue.id]:
-            fp = open(tkt.files.event_filename(issue.id, ev.id), 'w')
-            try:
-                ev.dump(fp)
-            finally:
-                fp.close()
+            storage.write_event(issue.id, ev.id, ev.dump())
 
-        fp = open(tkt.files.issue_filename(issue.id), 'w')
-        try:
-            issue.dump(fp)
-        finally:
-            fp.close()
+        storage.write_issue(issue.id, issue.dump())
 
 
 if __name__ == "__main__":
@@ -1,17 +1,20 @@
+import os
+import pkgutil
 import sys
 import traceback
 
+import tkt.commands
 import tkt.config
+import tkt.index
 
 
-def getplugins():
-    plugins = set(tkt.config.user().plugins + tkt.config.project().plugins)
+MANIFESTKEY = 'plugin-commands'
 
-    # we'll have to reload configs, so bust that cache
-    del tkt.config._user
-    del tkt.config._project
+def plugin_names():
+    return sorted(set(tkt.config.user().plugins + tkt.config.project().plugins))
 
-    for plugin in plugins:
+def getplugins():
+    for plugin in plugin_names():
         try:
             # plugins are responsible for attaching to the right hooks
             # all we do here is to import them
@@ -21,3 +24,47 @@ def getplugins():
             print titleline
             print "-" * len(titleline)
             print "".join(traceback.format_exception(*sys.exc_info()))
+
+    # plugins may have replaced the config classes, so rebuild the configs
+    tkt.config.reload()
+
+    if tkt.index.available():
+        index = tkt.index.metadata()
+        entry = (_fingerprint(plugin_names()), _commands())
+        if index.getmeta(MANIFESTKEY) != entry:
+            with index.conn:
+                index.setmeta(MANIFESTKEY, entry)
+
+def _fingerprint(plugins):
+    "the core commands' and plugin modules' source files' mtimes"
+    fingerprint = []
+    for plugin in [tkt.commands.__name__] + plugins:
+        mtime = None
+        try:
+            loader = pkgutil.get_loader(plugin)
+        except ImportError:
+            loader = None
+        if loader is not None:
+            mtime = os.stat(loader.get_filename()).st_mtime
+        fingerprint.append((plugin, mtime))
+    return fingerprint
+
+def _commands():
+    return dict((name, (cmd.__module__, cmd.__name__,
+                        getattr(cmd, 'usageinfo', None)))
+                for name, cmd in tkt.commands.Command.cmds.iteritems())
+
+def manifest():
+    """{command name: (module, class name, usage info)} with plugins loaded
+
+    it's kept in the index and only rebuilt, by importing all the plugins,
+    when the configured plugins or their source files change.
+    """
+    if tkt.index.available():
+        fingerprint, commands = tkt.index.metadata().getmeta(MANIFESTKEY,
+                                                            (None, None))
+        if fingerprint == _fingerprint(plugin_names()):
+            return commands
+
+    getplugins()
+    return _commands()
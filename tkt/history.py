@@ -0,0 +1,223 @@
+"""ticket state as a log of changes
+
+every event records the fields it changed as {field: [old, new]}. in an
+event-sourced project a ticket.yaml is only written when the ticket is
+created, and the ticket's current state is that plus the changes of all of
+its events, replayed in order. the metadata index caches the result.
+"""
+
+import bisect
+import copy
+import time
+
+import tkt.config
+import tkt.index
+import tkt.storage
+import tkt.timezones
+import yaml
+
+
+# how many events a checkpoint of a ticket's state gets taken after
+CHECKPOINT_INTERVAL = 20
+
+
+class HistoryError(ValueError):
+    pass
+
+def eventsourced():
+    return bool(tkt.config.project().eventsourced)
+
+def diff(old, new):
+    "the changes that turn the old ticket data into the new"
+    old = old or {}
+    changes = {}
+    for field, value in new.iteritems():
+        if old.get(field) != value:
+            changes[field] = [copy.deepcopy(old.get(field)),
+                              copy.deepcopy(value)]
+    return changes
+
+def merge(first, second):
+    "changes with the same effect as first and then second"
+    changes = dict(first)
+    for field, (old, new) in second.iteritems():
+        if field in changes:
+            old = changes[field][0]
+        if old == new:
+            changes.pop(field, None)
+        else:
+            changes[field] = [old, new]
+    return changes
+
+def apply(data, changes):
+    for field, (old, new) in (changes or {}).iteritems():
+        data[field] = new
+    return data
+
+def undo(data, changes):
+    for field, (old, new) in (changes or {}).iteritems():
+        data[field] = old
+    return data
+
+def recorded(event):
+    "whether an event says what it changed, older ones don't"
+    return 'changes' in event
+
+def events(issueid, eventids=None):
+    "the data of a ticket's events, in the order they happened"
+    storage = tkt.storage.backend()
+    if eventids is None:
+        eventids = storage.event_ids(issueid)
+
+    events = []
+    for eventid in eventids:
+        event = yaml.load(storage.read_event(issueid, eventid)) or {}
+        # ids only go down to the second, the creation times are finer
+        events.append((event.get('created'), eventid, event))
+    events.sort()
+    return [event for created, eventid, event in events]
+
+def replay(issueid):
+    "a ticket's data with the changes from all of its events applied"
+    data = yaml.load(tkt.storage.backend().read_issue(issueid)) or {}
+    for event in events(issueid):
+        apply(data, event.get('changes'))
+    return data
+
+def issue_data(issueid):
+    "the current data of a ticket, however the project keeps it"
+    if eventsourced():
+        return replay(issueid)
+    return yaml.load(tkt.storage.backend().read_issue(issueid))
+
+def issue_version(issueid):
+    "changes whenever issue_data would"
+    storage = tkt.storage.backend()
+    if eventsourced():
+        return storage.history_version(issueid)
+    return storage.issue_version(issueid)
+
+def _second(utc):
+    "the hex timestamp that ids of things created at a utc time start with"
+    return "%x" % int(time.mktime(utc.timetuple()))
+
+def _next_second(second):
+    return "%x" % (int(second, 16) + 1)
+
+def _first_state(issueid, events):
+    "a ticket's data from before all of its events"
+    if eventsourced():
+        return yaml.load(tkt.storage.backend().read_issue(issueid)) or {}
+
+    data = issue_data(issueid)
+    for event in reversed(events):
+        undo(data, event.get('changes'))
+    return data
+
+def checkpoints(issueid, eventids):
+    """(key, position, data) snapshots of a ticket's state, oldest first
+
+    each one is the state after the events with ids before its key, which
+    is the id prefix for a second, and position is how many there are of
+    those. they're kept in the index and a new one is taken whenever
+    CHECKPOINT_INTERVAL events have piled up since the last, but none from
+    before an event that didn't record its changes.
+    """
+    if not tkt.index.available():
+        return []
+    index = tkt.index.metadata()
+    stored = index.checkpoints(issueid)
+
+    # events turning up from before a checkpoint (synced or written by hand)
+    # spoil it and every one after it
+    points = []
+    for key, position, data in stored:
+        if bisect.bisect_left(eventids, key) != position:
+            break
+        points.append((key, position, data))
+
+    if points:
+        position, data = points[-1][1], copy.deepcopy(points[-1][2])
+    else:
+        position, data = 0, None
+    if len(eventids) - position < CHECKPOINT_INTERVAL:
+        if len(points) < len(stored):
+            index.store_checkpoints(issueid, points)
+        return points
+
+    later = events(issueid, eventids[position:])
+    if data is None:
+        data = _first_state(issueid, later)
+
+    count = 0
+    for i, event in enumerate(later):
+        if not recorded(event):
+            # the states before it aren't known, so neither are the
+            # checkpoints of them
+            del points[:]
+            count = 0
+        apply(data, event.get('changes'))
+        count += 1
+
+        # only whole seconds of events can be told apart by their ids
+        second = _second(event['created'])
+        if i + 1 < len(later) and _second(later[i + 1]['created']) == second:
+            continue
+        if count >= CHECKPOINT_INTERVAL:
+            key = _next_second(second)
+            points.append((key, bisect.bisect_left(eventids, key),
+                           copy.deepcopy(data)))
+            count = 0
+
+    index.store_checkpoints(issueid, points)
+    return points
+
+def issue_data_as_of(issueid, when):
+    """a ticket's data as it was at a local time, None if it was yet to come
+
+    the state gets rolled forward from the last checkpoint before the time,
+    or (when there's no such checkpoint or it's further off) back from the
+    current state by undoing the changes of the events since.
+    """
+    utc = tkt.timezones.to_utc(when)
+    second = _second(utc)
+
+    eventids = tkt.storage.backend().event_ids(issueid)
+    stop = bisect.bisect_left(eventids, _next_second(second))
+    later = len(eventids) - bisect.bisect_left(eventids, second)
+
+    start, data = 0, None
+    for key, position, checkpoint in checkpoints(issueid, eventids):
+        if key > second:
+            break
+        start, data = position, checkpoint
+
+    # checkpoints are only kept from after the last event that didn't
+    # record its changes, any such event after the time means the state
+    # then isn't known
+    if eventsourced() or data is not None and stop - start <= later:
+        if data is None:
+            data = yaml.load(tkt.storage.backend().read_issue(issueid)) or {}
+            gone_over = events(issueid, eventids[start:])
+        else:
+            gone_over = events(issueid, eventids[start:stop])
+        data = copy.deepcopy(data)
+        for event in gone_over:
+            if event.get('created') <= utc:
+                apply(data, event.get('changes'))
+    else:
+        data = issue_data(issueid)
+        gone_over = events(issueid, eventids[len(eventids) - later:])
+        for event in reversed(gone_over):
+            if event.get('created') > utc:
+                undo(data, event.get('changes'))
+
+    if data.get('created') is not None and data['created'] > utc:
+        return None
+
+    for event in gone_over:
+        if event.get('created') > utc and not recorded(event):
+            raise HistoryError("can't tell how ticket %s was then, its " %
+                    issueid + "event of %s didn't record what it changed" %
+                    event['created'].strftime("%Y-%m-%d %H:%M"))
+    return data
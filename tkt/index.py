@@ -0,0 +1,583 @@
+import cPickle
+import collections
+import difflib
+import itertools
+import os
+import sqlite3
+import sys
+
+import tkt.config
+import tkt.history
+import tkt.storage
+import tkt.utils
+
+
+CACHEFOLDERNAME = 'cache'
+DBFILENAME = 'index.db'
+
+# bump this whenever the schema or the pickled record format changes, an
+# index with a different version is thrown away and rebuilt from scratch
+SCHEMA_VERSION = 12
+
+SCHEMA = [
+    '''CREATE TABLE tickets (
+        id TEXT PRIMARY KEY,
+        version TEXT NOT NULL,
+        number INTEGER,
+        title TEXT,
+        data BLOB NOT NULL)''',
+    '''CREATE TABLE fields (
+        name TEXT NOT NULL,
+        id TEXT NOT NULL,
+        value BLOB,
+        PRIMARY KEY (name, id))''',
+    '''CREATE INDEX fields_by_id ON fields (id)''',
+    '''CREATE TABLE numbers (
+        number INTEGER NOT NULL,
+        id TEXT NOT NULL,
+        PRIMARY KEY (number, id))''',
+    '''CREATE INDEX numbers_by_id ON numbers (id)''',
+    '''CREATE TABLE claims (
+        number INTEGER PRIMARY KEY,
+        id TEXT NOT NULL)''',
+    '''CREATE TABLE meta (
+        name TEXT PRIMARY KEY,
+        value BLOB NOT NULL)''',
+    '''CREATE TABLE trigram_docs (
+        doc INTEGER PRIMARY KEY,
+        issueid TEXT NOT NULL,
+        eventid TEXT NOT NULL,
+        version TEXT NOT NULL,
+        UNIQUE (issueid, eventid))''',
+    '''CREATE TABLE trigrams (
+        trigram TEXT NOT NULL,
+        doc INTEGER NOT NULL,
+        PRIMARY KEY (trigram, doc))''',
+    '''CREATE INDEX trigrams_by_doc ON trigrams (doc)''',
+    '''CREATE TABLE text_docs (
+        doc INTEGER PRIMARY KEY,
+        issueid TEXT NOT NULL,
+        eventid TEXT NOT NULL,
+        version TEXT NOT NULL,
+        length INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (issueid, eventid))''',
+    '''CREATE TABLE postings (
+        term TEXT NOT NULL,
+        doc INTEGER NOT NULL,
+        tf INTEGER NOT NULL,
+        PRIMARY KEY (term, doc))''',
+    '''CREATE INDEX postings_by_doc ON postings (doc)''',
+    '''CREATE TABLE checkpoints (
+        issueid TEXT NOT NULL,
+        key TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (issueid, key))''',
+    '''CREATE TABLE summary (
+        key BLOB PRIMARY KEY,
+        count INTEGER NOT NULL)''',
+]
+
+# the fields tickets are counted by for status, plugins add theirs
+SUMMARY_FIELDS = ['type', 'status']
+
+def cachepath(*parts):
+    return os.path.join(cachefolder(tkt.config.datapath()), *parts)
+
+def cachefolder(datapath):
+    "the cache folder in a data folder, which gets made the first time"
+    folder = os.path.join(datapath, CACHEFOLDERNAME)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+        # everything in here is derived data, keep it out of version control
+        fp = open(os.path.join(folder, '.gitignore'), 'w')
+        try:
+            fp.write('*\n')
+        finally:
+            fp.close()
+
+    return folder
+
+def available():
+    # the index follows the working tree, not tickets read from git history
+    return os.path.isdir(tkt.config.datapath()) and \
+            tkt.storage.revision() is None
+
+def _create(conn):
+    tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")]
+
+    # everything else can be rebuilt from the tickets, but numbers handed
+    # out (to tickets not written yet, or dropped since) mustn't come back
+    counter, claims = None, []
+    if 'meta' in tables:
+        counter = conn.execute("SELECT value FROM meta " +
+                               "WHERE name = 'next-number'").fetchone()
+    if 'claims' in tables:
+        claims = conn.execute("SELECT number, id FROM claims").fetchall()
+
+    for table in tables:
+        conn.execute("DROP TABLE %s" % table)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+    if counter is not None:
+        conn.execute("INSERT INTO meta (name, value) " +
+                     "VALUES ('next-number', ?)", counter)
+    conn.executemany("INSERT INTO claims (number, id) VALUES (?, ?)", claims)
+
+def connection():
+    if '_connection' not in globals():
+        conn = sqlite3.connect(cachepath(DBFILENAME), timeout=30)
+        conn.text_factory = str
+
+        version, = conn.execute("PRAGMA user_version").fetchone()
+        if version != SCHEMA_VERSION:
+            with conn:
+                _create(conn)
+
+        globals()['_connection'] = conn
+
+    return globals()['_connection']
+
+def summary_stale(datapath):
+    "have another data folder's index count its tickets at its next refresh"
+    path = os.path.join(datapath, CACHEFOLDERNAME, DBFILENAME)
+    if not os.path.isfile(path):
+        return
+
+    conn = sqlite3.connect(path, timeout=30)
+    conn.text_factory = str
+    try:
+        version, = conn.execute("PRAGMA user_version").fetchone()
+        if version == SCHEMA_VERSION: # otherwise it gets rebuilt anyway
+            MetadataIndex(conn).summary_stale()
+    finally:
+        conn.close()
+
+def load_issue_data(issueid):
+    return tkt.history.issue_data(issueid)
+
+def metadata():
+    if '_metadata' not in globals():
+        globals()['_metadata'] = MetadataIndex(connection())
+    return globals()['_metadata']
+
+class MetadataIndex(object):
+    """the parsed header of every ticket, keyed by ticket id
+
+    each record remembers the storage version (mtime and size of the
+    ticket.yaml for plain files) it was parsed from, so refreshing only has to
+    check the versions and re-parse the tickets that changed. in an
+    event-sourced project the records are the replayed ticket states.
+    the whole yaml mapping is kept, so fields added by plugins come along.
+
+    each field of the records is also kept in a row of its own, so one of
+    them can be had for every ticket without unpickling whole records.
+
+    alongside, the summary counts the records by their SUMMARY_FIELDS values.
+    it changes with the records it counts, both in refreshes and when a
+    command stores a ticket, so reading it costs the same however many
+    tickets there are.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def refresh(self, issueids):
+        "bring the index up to date and return the ticket data in order"
+        storage = tkt.storage.backend()
+
+        known = {}
+        for row in self.conn.execute("SELECT id, version, data FROM tickets"):
+            known[row[0]] = row[1:]
+
+        records = []
+        missing = []
+        for issueid in issueids:
+            version = repr(tkt.history.issue_version(issueid))
+            row = known.pop(issueid, None)
+            if row is not None and row[0] == version:
+                records.append(row[1])
+                continue
+
+            missing.append((len(records), issueid, version,
+                            row and _unpickle(row[1])))
+            records.append(None)
+
+        # parsing is the expensive part, so a big rebuild gets spread out
+        parsed = tkt.utils.parallel_map(load_issue_data,
+                                        [m[1] for m in missing])
+        stale = []
+        changes = []
+        for (position, issueid, version, old), data in itertools.izip(
+                missing, parsed):
+            blob = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+            stale.append((issueid, version, data.get('number'),
+                          data.get('title'), sqlite3.Binary(blob)))
+            changes.append((old, data))
+            records[position] = blob
+        changes.extend((_unpickle(row[1]), None) for row in known.values())
+
+        if stale or known or self.getmeta('summary-stale'):
+            with self.conn:
+                self._count(changes)
+                self.setmeta('summary-stale', False)
+                self.conn.executemany("INSERT OR REPLACE INTO tickets " +
+                        "(id, version, number, title, data) " +
+                        "VALUES (?, ?, ?, ?, ?)", stale)
+                self.conn.executemany("DELETE FROM tickets WHERE id = ?",
+                        [(issueid,) for issueid in known])
+                self.conn.executemany(
+                        "DELETE FROM checkpoints WHERE issueid = ?",
+                        [(issueid,) for issueid in known])
+                self.conn.executemany("DELETE FROM fields WHERE id = ?",
+                        [(issueid,) for issueid in known])
+                for row, (old, data) in itertools.izip(stale, changes):
+                    self._store_fields(row[0], data)
+                # the tickets are written, their numbers are in the files now
+                self.conn.executemany("DELETE FROM claims WHERE id = ?",
+                        [(row[0],) for row in stale])
+                self._renumber()
+                self.setmeta('generation', self.generation() + 1)
+            self._warn_duplicates()
+
+        listing = storage.listing_version()
+        if listing != self.getmeta('listing'):
+            with self.conn:
+                self.setmeta('listing', listing)
+
+        return tkt.utils.LazySequence(len(records),
+                                      lambda i: _unpickle(records[i]))
+
+    def refresh_listing(self, issueids):
+        """catch up with tickets added or removed since the last refresh
+
+        this only reads the tickets that are new to the index.
+        """
+        known = set(row[0] for row in self.conn.execute(
+                "SELECT id FROM tickets"))
+        added = [issueid for issueid in issueids if issueid not in known]
+        removed = known.difference(issueids)
+
+        parsed = tkt.utils.parallel_map(load_issue_data, added)
+        with self.conn:
+            for issueid, data in itertools.izip(added, parsed):
+                self._store(issueid, data)
+            for issueid in removed:
+                self._drop(issueid)
+            self.conn.executemany("DELETE FROM claims WHERE id = ?",
+                                  [(issueid,) for issueid in added])
+            if added or removed:
+                self._renumber()
+            self.setmeta('listing', tkt.storage.backend().listing_version())
+        if added:
+            self._warn_duplicates()
+
+    def store(self, issueid, data):
+        """take a ticket's new data as soon as a command stores it
+
+        the record gets no version, so the next refresh reads the ticket
+        again whatever happened to the write.
+        """
+        with self.conn:
+            self._store(issueid, data)
+            self.setmeta('generation', self.generation() + 1)
+
+    def _store(self, issueid, data):
+        row = self.conn.execute("SELECT data FROM tickets WHERE id = ?",
+                                (issueid,)).fetchone()
+        self._count([(row and _unpickle(row[0]), data)])
+        self.conn.execute("INSERT OR REPLACE INTO tickets " +
+                "(id, version, number, title, data) VALUES (?, ?, ?, ?, ?)",
+                (issueid, '', data.get('number'), data.get('title'),
+                 sqlite3.Binary(cPickle.dumps(data,
+                                              cPickle.HIGHEST_PROTOCOL))))
+        self._store_fields(issueid, data)
+        if data.get('number') is not None:
+            self.conn.execute("DELETE FROM numbers WHERE id = ?", (issueid,))
+            self.conn.execute("INSERT INTO numbers (number, id) " +
+                    "VALUES (?, ?)", (data['number'], issueid))
+
+    def _store_fields(self, issueid, data):
+        self.conn.execute("DELETE FROM fields WHERE id = ?", (issueid,))
+        self.conn.executemany("INSERT INTO fields (name, id, value) " +
+                "VALUES (?, ?, ?)", [(name, issueid, sqlite3.Binary(
+                    cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)))
+                    for name, value in data.iteritems()])
+
+    def drop(self, issueid):
+        "forget a dropped ticket"
+        with self.conn:
+            self._drop(issueid)
+            self._renumber()
+            self.setmeta('generation', self.generation() + 1)
+
+    def _drop(self, issueid):
+        row = self.conn.execute("SELECT data FROM tickets WHERE id = ?",
+                                (issueid,)).fetchone()
+        if row is not None:
+            self._count([(_unpickle(row[0]), None)])
+        self.conn.execute("DELETE FROM tickets WHERE id = ?", (issueid,))
+        self.conn.execute("DELETE FROM fields WHERE id = ?", (issueid,))
+        self.conn.execute("DELETE FROM claims WHERE id = ?", (issueid,))
+        self.conn.execute("DELETE FROM checkpoints WHERE issueid = ?",
+                          (issueid,))
+
+    def _count(self, changes):
+        "apply (old data, new data) pairs of records to the summary"
+        if self.getmeta('summary-fields') != SUMMARY_FIELDS:
+            # counted by other fields, count the records there are first
+            self._recount()
+
+        deltas = collections.defaultdict(int)
+        for old, new in changes:
+            if old is not None:
+                deltas[summary_key(old)] -= 1
+            if new is not None:
+                deltas[summary_key(new)] += 1
+
+        for key, delta in deltas.iteritems():
+            if not delta:
+                continue
+            blob = sqlite3.Binary(cPickle.dumps(key, cPickle.HIGHEST_PROTOCOL))
+            self.conn.execute("INSERT OR IGNORE INTO summary (key, count) " +
+                    "VALUES (?, 0)", (blob,))
+            self.conn.execute("UPDATE summary SET count = count + ? " +
+                    "WHERE key = ?", (delta, blob))
+        self.conn.execute("DELETE FROM summary WHERE count = 0")
+
+    def _recount(self):
+        counts = collections.defaultdict(int)
+        for row in self.conn.execute("SELECT data FROM tickets"):
+            counts[summary_key(_unpickle(row[0]))] += 1
+
+        self.conn.execute("DELETE FROM summary")
+        self.conn.executemany("INSERT INTO summary (key, count) VALUES (?, ?)",
+                [(sqlite3.Binary(cPickle.dumps(key, cPickle.HIGHEST_PROTOCOL)),
+                  count) for key, count in counts.iteritems()])
+        self.setmeta('summary-fields', list(SUMMARY_FIELDS))
+
+    def recount(self):
+        "count the records over again"
+        with self.conn:
+            self._recount()
+
+    def summary(self):
+        """{(value of each of the SUMMARY_FIELDS): number of tickets}
+
+        None if it can't be trusted until the next refresh.
+        """
+        if self.getmeta('summary-stale'):
+            return None
+        if self.getmeta('summary-fields') != SUMMARY_FIELDS:
+            self.recount()
+
+        counts = collections.defaultdict(int)
+        for key, count in self.conn.execute("SELECT key, count FROM summary"):
+            counts[_unpickle(key)] += count
+        return dict(counts)
+
+    def summary_stale(self):
+        "tickets changed behind the index's back, count them at the next refresh"
+        with self.conn:
+            self.setmeta('summary-stale', True)
+
+    def _renumber(self):
+        rows = self.conn.execute(
+                "SELECT id, number FROM tickets ORDER BY id").fetchall()
+        self.conn.execute("DELETE FROM numbers")
+
+        # claimed numbers hold until their tickets have been read
+        self.conn.execute("INSERT INTO numbers (number, id) " +
+                "SELECT number, id FROM claims " +
+                "WHERE id NOT IN (SELECT id FROM tickets)")
+        self.conn.executemany(
+                "INSERT OR IGNORE INTO numbers (number, id) VALUES (?, ?)",
+                [(number, issueid) for issueid, number in rows
+                 if number is not None])
+
+        # older tickets without a stored number go by their position, unless
+        # a stored number has it
+        taken = set(row[0] for row in self.conn.execute(
+                "SELECT number FROM numbers"))
+        self.conn.executemany(
+                "INSERT INTO numbers (number, id) VALUES (?, ?)",
+                [(position, issueid) for position, (issueid, number)
+                 in enumerate(rows) if number is None and
+                 position not in taken])
+
+        # tickets from elsewhere can bring higher numbers along
+        top, = self.conn.execute("SELECT max(number) FROM numbers").fetchone()
+        if top is not None and top >= self.getmeta('next-number', 0):
+            self.setmeta('next-number', top + 1)
+
+    def duplicate_numbers(self):
+        "[(number, [ticket ids])] for the numbers more than one ticket has"
+        duplicates = collections.OrderedDict()
+        for number, issueid in self.conn.execute("SELECT number, id " +
+                "FROM numbers WHERE number IN (SELECT number FROM numbers " +
+                "GROUP BY number HAVING count(*) > 1) ORDER BY number, id"):
+            duplicates.setdefault(number, []).append(issueid)
+        return duplicates.items()
+
+    def _warn_duplicates(self):
+        # once per process for each, commands refresh more than once
+        warned = globals().setdefault('_warned', set())
+        for number, issueids in self.duplicate_numbers():
+            if (number, tuple(issueids)) in warned:
+                continue
+            warned.add((number, tuple(issueids)))
+            sys.stderr.write("warning: %s are all #%d, give all but one a " %
+                             (", ".join(issueids), number) +
+                             "new number with 'tkt renumber <id>'\n")
+
+    def listing_current(self):
+        "whether the set of ticket ids is the same as at the last refresh"
+        return self.getmeta('listing') == \
+                tkt.storage.backend().listing_version()
+
+    def records_current(self, issueids):
+        """whether every ticket's record is of the version stored now
+
+        this only looks at the storage versions, so edits made behind the
+        index's back get noticed without reading any tickets.
+        """
+        versions = dict(self.conn.execute("SELECT id, version FROM tickets"))
+        if len(versions) != len(issueids):
+            return False
+        for issueid in issueids:
+            if versions.get(issueid) != \
+                    repr(tkt.history.issue_version(issueid)):
+                return False
+        return True
+
+    def field(self, name):
+        "{ticket id: value} of a field, for every ticket that has it"
+        return dict((issueid, _unpickle(value)) for issueid, value in
+                    self.conn.execute("SELECT id, value FROM fields " +
+                                      "WHERE name = ?", (name,)))
+
+    def ids_with_prefix(self, prefix, limit):
+        return [row[0] for row in self.conn.execute(
+                "SELECT id FROM tickets WHERE id >= ? AND id < ? " +
+                "ORDER BY id LIMIT ?", (prefix, prefix + '\xff', limit))]
+
+    def ids_containing(self, piece, limit):
+        return [row[0] for row in self.conn.execute(
+                "SELECT id FROM tickets WHERE instr(id, ?) > 0 " +
+                "ORDER BY id LIMIT ?", (piece, limit))]
+
+    def similar_titles(self, text, limit):
+        "(id, title) pairs of the tickets with titles most like text"
+        text = text.lower()
+        words = text.split()
+
+        rows = []
+        if words:
+            rows = self.conn.execute(
+                    "SELECT id, title FROM tickets WHERE " +
+                    " OR ".join(["lower(title) LIKE ?"] * len(words)),
+                    ["%%%s%%" % word for word in words]).fetchall()
+        if not rows:
+            rows = self.conn.execute(
+                    "SELECT id, title FROM tickets").fetchall()
+
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(text)
+        scored = []
+        for issueid, title in rows:
+            matcher.set_seq1((title or '').lower())
+            if matcher.real_quick_ratio() < 0.3 or \
+                    matcher.quick_ratio() < 0.3:
+                continue
+            scored.append((matcher.ratio(), issueid, title))
+
+        scored.sort(reverse=True)
+        return [(issueid, title) for ratio, issueid, title in scored[:limit]]
+
+    def ids_for_number(self, number):
+        return [row[0] for row in self.conn.execute(
+                "SELECT id FROM numbers WHERE number = ? ORDER BY id",
+                (number,))]
+
+    def number_for_issue(self, issueid):
+        row = self.conn.execute("SELECT min(number) FROM numbers " +
+                                "WHERE id = ?", (issueid,)).fetchone()
+        return row[0]
+
+    def assign_number(self, issueid):
+        """atomically claim the next ticket number for a new ticket
+
+        numbers come off a counter that only ever goes up, and the claim is
+        kept until the ticket has been written and read back, so no
+        refresh in between can hand the number out again.
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            number = self.getmeta('next-number', 0)
+            self.setmeta('next-number', number + 1)
+            self.conn.execute("INSERT INTO claims (number, id) VALUES (?, ?)",
+                              (number, issueid))
+            self.conn.execute("DELETE FROM numbers WHERE id = ?", (issueid,))
+            self.conn.execute("INSERT INTO numbers (number, id) VALUES (?, ?)",
+                              (number, issueid))
+        return number
+
+    def checkpoints(self, issueid):
+        "(key, position, data) of the checkpoints of a ticket's history"
+        return [(key, position, _unpickle(data)) for key, position, data in
+                self.conn.execute("SELECT key, position, data " +
+                        "FROM checkpoints WHERE issueid = ? ORDER BY key",
+                        (issueid,))]
+
+    def store_checkpoints(self, issueid, checkpoints):
+        "replace all of a ticket's checkpoints"
+        with self.conn:
+            self.conn.execute("DELETE FROM checkpoints WHERE issueid = ?",
+                              (issueid,))
+            self.conn.executemany("INSERT INTO checkpoints " +
+                    "(issueid, key, position, data) VALUES (?, ?, ?, ?)",
+                    [(issueid, key, position, sqlite3.Binary(
+                        cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)))
+                     for key, position, data in checkpoints])
+
+    def drop_checkpoints(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM checkpoints")
+
+    def getmeta(self, name, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?",
+                                (name,)).fetchone()
+        if row is None:
+            return default
+        return _unpickle(row[0])
+
+    def setmeta(self, name, value):
+        "store a value, the caller is responsible for committing"
+        blob = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) " +
+                "VALUES (?, ?)", (name, sqlite3.Binary(blob)))
+
+    def generation(self):
+        return self.getmeta('generation', 0)
+
+    def cached(self, name):
+        "a value stored with cache(), if nothing has changed since"
+        generation, value = self.getmeta('cache:%s' % name, (None, None))
+        if generation != self.generation():
+            return None
+        return value
+
+    def cache(self, name, value):
+        with self.conn:
+            self.setmeta('cache:%s' % name, (self.generation(), value))
+
+def summary_key(data):
+    # a missing field and an empty one get counted together
+    return tuple(data.get(field) or None for field in SUMMARY_FIELDS)
+
+def _unpickle(blob):
+    return cPickle.loads(str(blob))
@@ -0,0 +1,104 @@
+"""advisory locks coordinating tkt processes sharing a data folder
+
+every command holds the repository lock shared, or exclusively for
+structural changes (dropping tickets, upgrades, storage conversion), and
+locks each ticket it is going to modify. locks are flock()s on files in the
+cache folder, so they go away with the process that held them.
+"""
+import contextlib
+import fcntl
+import os
+
+import tkt.config
+import tkt.index
+
+
+LOCKSFOLDERNAME = 'locks'
+REPOLOCKNAME = 'repo'
+
+SHARED = 'shared'
+EXCLUSIVE = 'exclusive'
+
+def _open(name, datapath=None):
+    folder = os.path.join(tkt.index.cachefolder(datapath or
+                                                tkt.config.datapath()),
+                          LOCKSFOLDERNAME)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    return open(os.path.join(folder, name), 'a')
+
+def _held():
+    return globals().setdefault('_locked', {})
+
+def lock_ticket(issueid):
+    "lock a ticket until the end of the current session"
+    held = _held()
+    if issueid in held or not tkt.index.available():
+        return
+    fp = _open("ticket-%s" % issueid)
+    if held and globals().get('_flush'):
+        # waiting with other tickets locked could deadlock with another
+        # session doing the same, so the session's writes go down first
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            globals()['_flush']()
+            release_tickets()
+            fcntl.flock(fp, fcntl.LOCK_EX)
+    else:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+    held[issueid] = fp
+
+def release_tickets():
+    "let go of the ticket locks taken so far"
+    held = _held()
+    for key, fp in held.items():
+        if not os.path.isabs(key): # another data folder's, from lock_project
+            fp.close()
+            del held[key]
+
+def lock_project(datapath):
+    """lock another data folder's repository exclusively, for the session
+
+    this doesn't wait, since its owner could be after ours. returns whether
+    the lock was had.
+    """
+    key = os.path.abspath(datapath)
+    held = _held()
+    if key in held:
+        return True
+
+    fp = _open(REPOLOCKNAME, datapath)
+    try:
+        fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        fp.close()
+        return False
+    held[key] = fp
+    return True
+
+@contextlib.contextmanager
+def session(mode=SHARED, flush=None):
+    """hold the repository lock in a mode, and release ticket locks after
+
+    a session inside another one just joins it. a session spanning several
+    commands passes flush, which makes the writes made so far durable: it
+    gets called before ticket locks are let go in the middle of the session.
+    """
+    if '_session' in globals() or mode is None or \
+            not tkt.index.available():
+        yield
+        return
+
+    fp = _open(REPOLOCKNAME)
+    fcntl.flock(fp, mode == EXCLUSIVE and fcntl.LOCK_EX or fcntl.LOCK_SH)
+    globals()['_session'] = fp
+    globals()['_flush'] = flush
+    try:
+        yield
+    finally:
+        del globals()['_session'], globals()['_flush']
+        for ticketfp in _held().values():
+            ticketfp.close()
+        _held().clear()
+        fp.close()
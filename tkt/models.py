@@ -1,16 +1,34 @@
+import bisect
+import datetime
 import functools
-import glob
 import itertools
 import os
 import platform
+import time
 
 import tkt.config
 import tkt.flextime
+import tkt.history
+import tkt.index
+import tkt.storage
 import tkt.timezones
 import tkt.utils
 import yaml
 
 
+def id_timestamp(dt):
+    "the hex timestamp that ids of things created at a local time start with"
+    return "%x" % int(time.mktime(tkt.timezones.to_utc(dt).timetuple()))
+
+def ids_created(ids, after=None, before=None):
+    "the slice of sorted ids created from after up to (not including) before"
+    start, stop = 0, len(ids)
+    if after is not None:
+        start = bisect.bisect_left(ids, id_timestamp(after))
+    if before is not None:
+        stop = bisect.bisect_left(ids, id_timestamp(before))
+    return ids[start:stop]
+
 class Model(object):
     def __init__(self, data):
         data = data or {}
@@ -41,7 +59,11 @@ class Model(object):
 
     @classmethod
     def load(cls, stream):
-        obj = cls(yaml.load(stream))
+        return cls.fromdata(yaml.load(stream))
+
+    @classmethod
+    def fromdata(cls, data):
+        obj = cls(data)
         obj.timezones_to_local()
         return obj
 
@@ -53,11 +75,16 @@ class Model(object):
         finally:
             fp.close()
 
-    def dump(self, stream=None):
+    def state(self):
+        "the data as it gets written out"
         self.timezones_to_utc()
-        data = self.yamlable()
-        self.timezones_to_local()
-        return yaml.dump(data, stream=stream, default_flow_style=False)
+        try:
+            return self.yamlable()
+        finally:
+            self.timezones_to_local()
+
+    def dump(self, stream=None):
+        return yaml.dump(self.state(), stream=stream, default_flow_style=False)
 
     def view_one_char(self):
         return "?"
@@ -69,7 +96,7 @@ class Model(object):
         return "not implemented"
 
 class UserConfig(Model):
-    fields = ['username', 'useremail', 'plugins']
+    fields = ['username', 'useremail', 'plugins', 'prefetch']
 
     RCFILENAME = '.tktrc.yaml'
 
@@ -77,6 +104,7 @@ class UserConfig(Model):
         Model.__init__(self, data)
 
         self.plugins = self.plugins or []
+        self.prefetch = self.prefetch or 0
         self.username = self.username or self.default_username()
         self.useremail = self.useremail or self.default_useremail()
 
@@ -111,13 +139,15 @@ class UserConfig(Model):
         return "%s@%s" % (self.username.lower().replace(" ", "."), hostname)
 
 class ProjectConfig(Model):
-    fields = ['plugins']
+    fields = ['plugins', 'storage', 'eventsourced']
 
     RCFILENAME = 'project.yaml'
 
     def __init__(self, data):
         Model.__init__(self, data)
         self.plugins = self.plugins or []
+        self.storage = self.storage or 'files'
+        self.eventsourced = bool(self.eventsourced)
 
     @classmethod
     def findpath(cls):
@@ -141,29 +171,163 @@ class ProjectConfig(Model):
         return os.path.join(os.path.abspath('.'), tkt.config.DATAFOLDERNAME,
                             cls.RCFILENAME), False
 
-    def _load_issue(self, number, filename):
-        issue = Issue.loadfile(filename)
+    def _load_issue(self, number, issueid):
+        return self._init_issue(number,
+                Issue.fromdata(tkt.history.issue_data(issueid)))
+
+    def _init_issue(self, number, issue):
         issue.project = self
+        if issue.number is not None:
+            number = issue.number
         issue.name = "#%d" % number
         issue.__class__.longestname = max(len(issue.name),
                                           issue.__class__.longestname)
         return issue
 
+    def forget(self):
+        "drop everything loaded from the tickets, they may have changed"
+        tkt.storage.backend().refresh()
+        for name in ("issuedata", "_issue_ids", "_issue_numbers",
+                     "_loaded_issues"):
+            self.__dict__.pop(name, None)
+
     @property
-    def issue_filenames(self):
-        if not hasattr(self, "_issue_filenames"):
-            self._issue_filenames = names = glob.glob(
-                    "%s%stickets%s*%sticket.yaml" % (
-                    tkt.config.datapath(), os.sep, os.sep, os.sep))
-            names.sort()
-        return self._issue_filenames
+    def issue_ids(self):
+        if not hasattr(self, "_issue_ids"):
+            self._issue_ids = tkt.storage.backend().issue_ids()
+        return self._issue_ids
+
+    @property
+    def listed_issue_ids(self):
+        "the ticket ids in the order the issues list has them"
+        return self.issue_ids
+
+    def load_issue(self, issueid):
+        loaded = self.__dict__.setdefault("_loaded_issues", {})
+        if issueid not in loaded:
+            loaded[issueid] = self._load_issue(self._number_for(issueid),
+                                               issueid)
+        return loaded[issueid]
+
+    def reload_issue(self, issueid):
+        "load a ticket again, in case it changed on disk"
+        tkt.storage.backend().refresh()
+        self.__dict__.get("_loaded_issues", {}).pop(issueid, None)
+        return self.load_issue(issueid)
+
+    def _number_for(self, issueid):
+        if tkt.index.available():
+            number = tkt.index.metadata().number_for_issue(issueid)
+            if number is not None:
+                return number
+
+        if not hasattr(self, "_issue_numbers"):
+            self._issue_numbers = dict((i, number) for number, i in
+                                       enumerate(self.issue_ids))
+        return self._issue_numbers[issueid]
+
+    def issue_ids_numbered(self, number):
+        """ids of the tickets with a number, without listing every ticket if
+        possible. there's only more than one when copies got merged.
+        """
+        if not tkt.index.available():
+            return [issue.id for issue in self.issues
+                    if issue.name == "#%d" % number]
+
+        index = self._current_index()
+        storage = tkt.storage.backend()
+        issueids = index.ids_for_number(number)
+        if not issueids or not all(map(storage.has_issue, issueids)):
+            # the index may not know about tickets from elsewhere yet
+            index.refresh(self.issue_ids)
+            issueids = [issueid for issueid in index.ids_for_number(number)
+                        if storage.has_issue(issueid)]
+        return issueids
+
+    def issue_for_number(self, number):
+        "the ticket with a number, None unless there's exactly one"
+        issueids = self.issue_ids_numbered(number)
+        if len(issueids) != 1:
+            return None
+        return self.load_issue(issueids[0])
+
+    def _current_index(self):
+        index = tkt.index.metadata()
+        if not index.listing_current():
+            index.refresh(self.issue_ids)
+        return index
+
+    def issue_ids_like(self, name, limit=6):
+        "ids of the tickets that start with name, or else that contain it"
+        if not tkt.index.available():
+            return [i for i in self.issue_ids if name in i][:limit]
+
+        index = self._current_index()
+        return index.ids_with_prefix(name, limit) or \
+                index.ids_containing(name, limit)
+
+    def issues_titled_like(self, text, limit=5):
+        "(id, title) pairs of the tickets with the most similar titles"
+        if not tkt.index.available():
+            return []
+        return self._current_index().similar_titles(text, limit)
+
+    def issue_ids_created(self, after=None, before=None):
+        "ids of the tickets created in a window, going by the ids alone"
+        return ids_created(self.issue_ids, after, before)
+
+    def issues_created(self, after=None, before=None):
+        "the tickets created in a window, each loaded when it's first used"
+        issueids = self.issue_ids_created(after, before)
+        return tkt.utils.LazySequence(len(issueids),
+                                      lambda i: self.load_issue(issueids[i]))
+
+    def issue_as_of(self, issueid, when):
+        "a ticket as it was at a local time, None if it didn't exist yet"
+        data = tkt.history.issue_data_as_of(issueid, when)
+        if data is None:
+            return None
+        issue = self._init_issue(self._number_for(issueid),
+                                 Issue.fromdata(data))
+        issue.as_of = when
+        return issue
+
+    def issues_as_of(self, when):
+        "the tickets as they were at a local time"
+        issueids = self.issue_ids_created(
+                before=when + datetime.timedelta(seconds=1))
+        issues = [self.issue_as_of(issueid, when) for issueid in issueids]
+        return [issue for issue in issues if issue is not None]
+
+    def issue_field(self, name):
+        "{ticket id: value} of a field of every ticket, from the index if any"
+        if not tkt.index.available():
+            return dict((issue.id, getattr(issue, name, None))
+                        for issue in self.issues)
+
+        index = tkt.index.metadata()
+        if not index.records_current(self.issue_ids):
+            index.refresh(self.issue_ids)
+        return index.field(name)
+
+    def next_number(self, issueid):
+        if not tkt.index.available():
+            return len(self.issue_ids)
+        # tickets from elsewhere may have taken numbers the index hasn't seen
+        return self._current_index().assign_number(issueid)
 
     @property
     def issues(self):
         if not hasattr(self, "issuedata"):
-            issuefiles = self.issue_filenames
-            self.issuedata = tkt.utils.LazyLoadingList(itertools.starmap(
-                self._load_issue, enumerate(issuefiles)))
+            issueids = self.issue_ids
+            if tkt.index.available():
+                records = tkt.index.metadata().refresh(issueids)
+                load = lambda i: self._init_issue(i,
+                                                  Issue.fromdata(records[i]))
+            else:
+                load = lambda i: self._load_issue(i, issueids[i])
+            self.issuedata = tkt.utils.LazySequence(len(issueids), load,
+                    prefetch=tkt.config.user().prefetch)
         return self.issuedata
 
 class OverallConfig(object):
@@ -191,6 +355,7 @@ class Event(Model):
         "created",
         "creator",
         "comment",
+        "changes",
     ]
 
     def __lt__(self, other):
@@ -202,20 +367,26 @@ class Event(Model):
     def timezones_to_local(self):
         self.created = tkt.timezones.to_local(self.created)
 
+    def view_changes(self):
+        return "".join("\n    %s: %s -> %s" % (field, old, new)
+                       for field, (old, new) in sorted(self.changes.items()))
+
     def view_detail(self):
         if self.comment:
             comment = "\n  > %s" % "\n  > ".join(self.comment.splitlines())
         else:
             comment = ""
-        return "- %s (%s, %s)%s" % (
+        return "- %s (%s, %s)%s%s" % (
             self.title,
             self.creator,
             "%s ago" % tkt.flextime.since(self.created),
+            self.changes and self.view_changes() or "",
             comment)
 
 class Issue(Model):
     fields = [
         "id",
+        "number",
         "title",
         "description",
         "created",
@@ -276,21 +447,26 @@ class Issue(Model):
     def resolutions_text(cls, splitter='\n'):
         return splitter.join("(%d) %s" % pair for pair in cls.resolutions)
 
-    def _load_event(self, filename):
-        event = Event.loadfile(filename)
+    def _load_event(self, eventid):
+        event = Event.load(tkt.storage.backend().read_event(self.id, eventid))
         event.issue = self
         return event
 
+    # the local time a ticket loaded from its history was as of
+    as_of = None
+
     @property
     def events(self):
         if not hasattr(self, "eventdata"):
-            eventfiles = glob.glob("%s%stickets%s%s%s*.yaml" % (
-                tkt.config.datapath(), os.sep, os.sep, self.id, os.sep))
-            eventfiles = [f for f in eventfiles
-                          if os.path.basename(f) != "ticket.yaml"]
-            eventfiles.sort()
-            self.eventdata = tkt.utils.LazyLoadingList(
-                    itertools.imap(self._load_event, eventfiles))
+            eventids = tkt.storage.backend().event_ids(self.id)
+            events = itertools.imap(self._load_event, eventids)
+            if self.as_of is not None:
+                eventids = ids_created(eventids,
+                        before=self.as_of + datetime.timedelta(seconds=1))
+                events = (event for event in
+                          itertools.imap(self._load_event, eventids)
+                          if event.created <= self.as_of)
+            self.eventdata = tkt.utils.LazyLoadingList(events)
         return self.eventdata
 
     def __lt__(self, other):
@@ -302,12 +478,16 @@ class Issue(Model):
     def timezones_to_local(self):
         self.created = tkt.timezones.to_local(self.created)
 
-    def view_one_char(self):
-        for char, status in self.statuses:
-            if self.status == status:
+    @classmethod
+    def status_char(cls, status):
+        for char, name in cls.statuses:
+            if status == name:
                 return char
         return "?"
 
+    def view_one_char(self):
+        return self.status_char(self.status)
+
     @property
     def valid_names(self):
         names = set([self.name, self.id])
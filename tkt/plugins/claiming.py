@@ -1,6 +1,7 @@
 import datetime
 import re
 
+import tkt.aggregate
 import tkt.commands
 import tkt.config
 import tkt.models
@@ -107,13 +108,16 @@ class Unassign(tkt.commands.Command):
 
 tkt.commands.aliases("unclaim")(Unassign)
 
+def issue_owned(issue):
+    return bool(issue.owner)
+
 class Unassigned(tkt.commands.Command):
     usageinfo = "list tickets which have no owner"
 
     def main(self):
-        for issue in self.project.issues:
-            if not issue.owner:
-                print issue.view_one_line()
+        owned = tkt.aggregate.aggregate(self.project.issues, issue_owned)
+        for issue in owned.issues(issue_owned, False):
+            print issue.view_one_line()
 
 tkt.commands.aliases("unclaimed")(Unassigned)
 tkt.commands.aliases("unowned")(Unassigned)
@@ -1,7 +1,10 @@
+import collections
 import datetime
+import heapq
+import operator
 
 import tkt.commands
-import tkt.files
+import tkt.index
 import tkt.models
 
 
@@ -16,22 +19,220 @@ tkt.commands.Search.options.append({
 })
 tkt.commands.Search.filters.append("dependency")
 
+class LazyIssues(object):
+    "tickets by id, each one loaded the first time it's asked for"
+
+    def __init__(self, issueids, load):
+        self.ids = set(issueids)
+        self.load = load
+        self.loaded = {}
+
+    def __contains__(self, issueid):
+        return issueid in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, issueid):
+        if issueid not in self.ids:
+            raise KeyError(issueid)
+        if issueid not in self.loaded:
+            self.loaded[issueid] = self.load(issueid)
+        return self.loaded[issueid]
+
+    def __setitem__(self, issueid, issue):
+        self.ids.add(issueid)
+        self.loaded[issueid] = issue
+
+    def pop(self, issueid, default=None):
+        self.ids.discard(issueid)
+        return self.loaded.pop(issueid, default)
+
+class DependencyGraph(object):
+    """forward and reverse dependency edges between tickets, keyed by id
+
+    transitive closures are computed once per ticket and memoized until the
+    edges change, and cycle detection is a single depth-first walk.
+    """
+
+    WHITE, GRAY, BLACK = range(3)
+
+    def __init__(self, issues=()):
+        self.issues = {}
+        self.created = {}
+        self.forward = {}
+        self.reverse = collections.defaultdict(set)
+        self._closures = {}
+
+        for issue in issues:
+            self.add(issue)
+
+    @classmethod
+    def from_fields(cls, project):
+        """the graph of a project's tickets, from their indexed fields
+
+        the tickets themselves only get loaded when they're looked at.
+        """
+        graph = cls()
+        graph.created = project.issue_field('created')
+        graph.issues = LazyIssues(graph.created, project.load_issue)
+        dependencies = project.issue_field('dependencies')
+        for issueid in graph.created:
+            graph.set_dependencies(issueid, dependencies.get(issueid) or [])
+        return graph
+
+    def add(self, issue):
+        self.issues[issue.id] = issue
+        self.created[issue.id] = issue.created
+        self.set_dependencies(issue.id, issue.dependencies or [])
+
+    def remove(self, issueid):
+        self.set_dependencies(issueid, [])
+        del self.forward[issueid]
+        self.issues.pop(issueid, None)
+        self.created.pop(issueid, None)
+
+    def set_dependencies(self, issueid, depids):
+        for depid in self.forward.get(issueid, ()):
+            self.reverse[depid].discard(issueid)
+        self.forward[issueid] = list(depids)
+        for depid in depids:
+            self.reverse[depid].add(issueid)
+        self._closures.clear()
+
+    def closure(self, issueid):
+        "ids of every ticket that issueid depends on, directly or not"
+        if issueid in self._closures:
+            return self._closures[issueid]
+
+        path = [issueid]
+        onpath = set(path)
+        stack = [iter(self.forward.get(issueid, ()))]
+        while stack:
+            for child in stack[-1]:
+                if child not in self._closures and child not in onpath:
+                    path.append(child)
+                    onpath.add(child)
+                    stack.append(iter(self.forward.get(child, ())))
+                    break
+            else:
+                stack.pop()
+                node = path.pop()
+                onpath.discard(node)
+
+                closure = set()
+                for child in self.forward.get(node, ()):
+                    closure.add(child)
+                    closure.update(self._closures.get(child, ()))
+                self._closures[node] = frozenset(closure)
+
+        return self._closures[issueid]
+
+    def find_cycle(self):
+        "a list of ids walking around a dependency cycle, or None"
+        color = {}
+        for root in sorted(self.forward):
+            if color.get(root, self.WHITE) != self.WHITE:
+                continue
+
+            path = [root]
+            color[root] = self.GRAY
+            stack = [iter(self.forward[root])]
+            while stack:
+                for child in stack[-1]:
+                    state = color.get(child, self.WHITE)
+                    if state == self.GRAY:
+                        return path[path.index(child):] + [child]
+                    if state == self.WHITE:
+                        color[child] = self.GRAY
+                        path.append(child)
+                        stack.append(iter(self.forward.get(child, ())))
+                        break
+                else:
+                    stack.pop()
+                    color[path.pop()] = self.BLACK
+
+        return None
+
+    def describe(self, issueids):
+        return " -> ".join(self.issues[i].name if i in self.issues else i
+                           for i in issueids)
+
+    def dependencies(self, issueid, transitive=True):
+        if transitive:
+            depids = self.closure(issueid)
+        else:
+            depids = self.forward.get(issueid, ())
+        return sorted((self.issues[d] for d in depids if d in self.issues),
+                      key=operator.attrgetter('created'))
+
+    def topological_order(self):
+        "ticket ids with dependencies ahead of their dependents, oldest first"
+        key = lambda issueid: (self.created[issueid], issueid)
+
+        indegree = dict.fromkeys(self.issues, 0)
+        for issueid in self.issues:
+            for depid in set(self.forward.get(issueid, ())):
+                if depid in indegree:
+                    indegree[issueid] += 1
+
+        ready = [key(i) for i, count in indegree.iteritems() if not count]
+        heapq.heapify(ready)
+
+        order = []
+        while ready:
+            created, issueid = heapq.heappop(ready)
+            order.append(issueid)
+            for dependent in self.reverse.get(issueid, ()):
+                if dependent in indegree:
+                    indegree[dependent] -= 1
+                    if not indegree[dependent]:
+                        heapq.heappush(ready, key(dependent))
+
+        if len(order) < len(indegree):
+            # whatever is caught in a cycle goes last, in creation order
+            placed = set(order)
+            order.extend(sorted((i for i in indegree if i not in placed),
+                                key=key))
+
+        return order
+
+def dependency_graph(project):
+    if not hasattr(project, "_dependency_graph"):
+        if tkt.index.available():
+            project._dependency_graph = DependencyGraph.from_fields(project)
+        else:
+            project._dependency_graph = DependencyGraph(project._oldissues)
+    return project._dependency_graph
+
+_oldforget = tkt.models.ProjectConfig.forget
+def forget(self):
+    _oldforget(self)
+    self.__dict__.pop("_dependency_graph", None)
+    self.__dict__.pop("_issues_dependency_sorted", None)
+    self.__dict__.pop("_listed_issue_ids", None)
+tkt.models.ProjectConfig.forget = forget
+
 def filter_dependency(self, issue):
     if not self.parsed_options.dependency:
         return True
     if not issue.dependencies:
         return self.parsed_options.dependency.lower() in self.nulls
-    for iss in self.project.issues:
-        if self.parsed_options.dependency.lower() in iss.valid_names:
-            break
-    else:
-        self.fail("not a valid issue name: %s" %
-                self.parsed_options.dependency)
 
-    if not hasattr(issue, 'deps'):
-        issue.deps = get_dependencies(issue)
+    if not hasattr(self, "_dependency_target"):
+        for iss in self.project.issues:
+            if self.parsed_options.dependency.lower() in iss.valid_names:
+                self._dependency_target = iss.id
+                break
+        else:
+            self.fail("not a valid issue name: %s" %
+                    self.parsed_options.dependency)
 
-    return iss in issue.deps
+    graph = dependency_graph(self.project)
+    return self._dependency_target in graph.closure(issue.id)
 tkt.commands.Search.filter_dependency = filter_dependency
 
 def validate_dependencies(self, deps):
@@ -39,54 +240,51 @@ def validate_dependencies(self, deps):
     depset = set(deps)
     if len(deps) > len(depset):
         return False
-    if set(i.id for i in self.project.issues) < depset:
+
+    graph = dependency_graph(self.project)
+    if not depset <= set(graph.issues):
         return False
-    for issue in self.project.issues:
-        try:
-            # not the most efficient way of finding cyclic dependencies...
-            get_dependencies(issue)
-        except RuntimeError:
-            return False
+
+    graph.set_dependencies(self.issue.id, deps)
+    cycle = graph.find_cycle()
+    if cycle:
+        self.fail("cyclic dependency: %s" % graph.describe(cycle))
     return True
 tkt.commands.Edit.validate_dependencies = validate_dependencies
 
 def get_dependencies(self, sort=True):
-    dep_issues = set()
-    depids = set(self.dependencies or [])
-    for issue in self.project.issues:
-        if not depids:
-            break
-        if issue.id in depids:
-            depids.discard(issue.id)
-            dep_issues.add(issue)
-            dep_issues.update(get_dependencies(issue))
-
+    graph = dependency_graph(self.project)
     if not sort:
-        return dep_issues
-
-    return sorted(dep_issues)
+        return set(graph.issues[d] for d in graph.closure(self.id)
+                   if d in graph.issues)
+    return graph.dependencies(self.id)
 
 def view_dependencies(self):
     return ", ".join(d.name for d in get_dependencies(self))
 
 tkt.models.Issue.view_dependencies = view_dependencies
 
-oldlt = tkt.models.Issue.__lt__
-def lessthan(self, other):
-    "monkeypatch Issue.__lt__ so that ticket sorting considers dependencies"
-    if not hasattr(self, 'deps'):
-        self.deps = get_dependencies(self, sort=False)
-
-    if other in self.deps:
-        return False
-
-    if not hasattr(other, 'deps'):
-        other.deps = get_dependencies(other, sort=False)
-
-    if self in other.deps:
-        return True
-
-    return oldlt(self, other)
+def dependency_order(project):
+    "ticket ids in dependency order, cached in the index between changes"
+    if not tkt.index.available():
+        return dependency_graph(project).topological_order()
+
+    index = tkt.index.metadata()
+    order = index.cached('dependency-order')
+    if order is None:
+        order = dependency_graph(project).topological_order()
+        index.cache('dependency-order', order)
+    return order
+
+def listed_issue_ids(self):
+    if not hasattr(self, "_listed_issue_ids"):
+        position = dict((issueid, i) for i, issueid in
+                        enumerate(dependency_order(self)))
+        last = len(position)
+        self._listed_issue_ids = sorted(self.issue_ids,
+                key=lambda issueid: position.get(issueid, last))
+    return self._listed_issue_ids
+tkt.models.ProjectConfig.listed_issue_ids = property(listed_issue_ids)
 
 tkt.models.ProjectConfig._oldissues = tkt.models.ProjectConfig.issues
 def listissues(self):
@@ -94,15 +292,36 @@ def listissues(self):
     if not hasattr(self, "_issues_dependency_sorted"):
         self._issues_dependency_sorted = 1
 
-        for issue in issuelist:
-            issue.deps = get_dependencies(issue, 0)
-
-        tkt.models.Issue.__lt__ = lessthan
-        issuelist.sort()
+        # going by the ids leaves the tickets unloaded
+        index = dict((issueid, i) for i, issueid in
+                     enumerate(self.issue_ids))
+        issuelist.reorder([index[issueid]
+                           for issueid in self.listed_issue_ids])
 
     return issuelist
 tkt.models.ProjectConfig.issues = property(listissues)
 
+_oldissuesasof = tkt.models.ProjectConfig.issues_as_of
+def issues_as_of(self, when):
+    position = dict((issueid, i) for i, issueid in
+                    enumerate(dependency_order(self)))
+    last = len(position)
+    return sorted(_oldissuesasof(self, when),
+                  key=lambda issue: position.get(issue.id, last))
+tkt.models.ProjectConfig.issues_as_of = issues_as_of
+
+def open_dependencies(self, issue):
+    graph = dependency_graph(self.project)
+    return [d for d in graph.dependencies(issue.id, transitive=False)
+            if d.status != tkt.models.Issue.CLOSED]
+
+def report_open_dependencies(opendeps):
+    if opendeps[1:]:
+        print "Ticket has open dependencies %s" % \
+                ", ".join(d.name for d in opendeps)
+    else:
+        print "Ticket has open dependency %s" % opendeps[0].name
+
 class Depend(tkt.commands.Command):
     usage = "<ticket> [<dependency>]"
 
@@ -110,7 +329,6 @@ class Depend(tkt.commands.Command):
 
     def main(self):
         issue = self.gather_ticket(try_prompting=False)
-        issue.deps = get_dependencies(issue, sort=False)
 
         self.parsed_args.pop(0)
 
@@ -123,13 +341,12 @@ class Depend(tkt.commands.Command):
         if not issue.dependencies:
             issue.dependencies = []
         issue.dependencies.append(otherissue.id)
-        issue.deps.add(otherissue)
 
-        try:
-            issue.deps.update(get_dependencies(otherissue))
-            get_dependencies(issue)
-        except RuntimeError:
-            self.fail("no cyclic dependencies")
+        graph = dependency_graph(self.project)
+        graph.set_dependencies(issue.id, issue.dependencies)
+        cycle = graph.find_cycle()
+        if cycle:
+            self.fail("no cyclic dependencies: %s" % graph.describe(cycle))
 
         self.store_issue(issue)
         self.store_new_event(issue,
@@ -143,19 +360,11 @@ tkt.commands.aliases('dependency', 'depends')(Depend)
 oldstartmain = tkt.commands.Start.main
 def startmain(self):
     issue = self.gather_ticket()
-    self.gather_ticket = lambda: issue
+    self.gather_ticket = lambda *args, **kwargs: issue
 
-    if not hasattr(issue, 'deps'):
-        issue.deps = get_dependencies(issue)
-
-    opendeps = [d for d in issue.deps if d.status != tkt.models.Issue.CLOSED]
-    opendeps = [d for d in opendeps if d.id in (issue.dependencies or [])]
+    opendeps = open_dependencies(self, issue)
     if opendeps:
-        if opendeps[1:]:
-            print "Ticket has open dependencies %s" % \
-                    ", ".join(d.name for d in opendeps)
-        else:
-            print "Ticket has open dependency %s" % opendeps[0].name
+        report_open_dependencies(opendeps)
         response = self.prompt("Start this ticket anyway? [y/N]")
 
         if not response or response[0].lower() != 'y':
@@ -168,19 +377,11 @@ tkt.commands.Start.main = startmain
 oldclosemain = tkt.commands.Close.main
 def closemain(self):
     issue = self.gather_ticket()
-    self.gather_ticket = lambda: issue
-
-    if not hasattr(issue, 'deps'):
-        issue.deps = get_dependencies(issue)
+    self.gather_ticket = lambda *args, **kwargs: issue
 
-    opendeps = [d for d in issue.deps if d.status != tkt.models.Issue.CLOSED]
-    opendeps = [d for d in opendeps if d.id in (issue.dependencies or [])]
+    opendeps = open_dependencies(self, issue)
     if opendeps:
-        if opendeps[1:]:
-            print "Ticket has open dependencies %s" % \
-                    ", ".join(d.name for d in opendeps)
-        else:
-            print "Ticket has open dependency %s" % opendeps[0].name
+        report_open_dependencies(opendeps)
         response = self.prompt("Close this ticket and remove open " +
                                "depenencies? [y/N]")
 
@@ -190,6 +391,8 @@ def closemain(self):
     if issue.dependencies:
         for baddep in opendeps:
             issue.dependencies.remove(baddep.id)
+        dependency_graph(self.project).set_dependencies(issue.id,
+                                                        issue.dependencies)
 
     oldclosemain(self)
 
@@ -198,19 +401,11 @@ tkt.commands.Close.main = closemain
 oldqamain = tkt.commands.QA.main
 def qamain(self):
     issue = self.gather_ticket()
-    self.gather_ticket = lambda: issue
-
-    if not hasattr(issue, 'deps'):
-        issue.deps = get_dependencies(issue)
+    self.gather_ticket = lambda *args, **kwargs: issue
 
-    opendeps = [d for d in issue.deps if d.status != tkt.models.Issue.CLOSED]
-    opendeps = [d for d in opendeps if d.id in (issue.dependencies or [])]
+    opendeps = open_dependencies(self, issue)
     if opendeps:
-        if opendeps[1:]:
-            print "Ticket has open dependencies %s" % \
-                    ", ".join(d.name for d in opendeps)
-        else:
-            print "Ticket has open dependency %s" % opendeps[0].name
+        report_open_dependencies(opendeps)
         response = self.prompt("Send this ticket to QA anyway? [y/N]")
 
         if not response or response[0].lower() != 'y':
@@ -223,17 +418,15 @@ tkt.commands.QA.main = qamain
 olddropmain = tkt.commands.Drop.main
 def dropmain(self):
     issue = self.gather_ticket()
-    self.gather_ticket = lambda: issue
-
-    for otherissue in self.project.issues:
-        if issue.id in (otherissue.dependencies or []):
-            otherissue.dependencies.remove(issue.id)
-            otherissue.deps = get_dependencies(otherissue)
-            fp = open(tkt.files.issue_filename(otherissue.id), 'w')
-            try:
-                otherissue.dump(fp)
-            finally:
-                fp.close()
+    self.gather_ticket = lambda *args, **kwargs: issue
+
+    graph = dependency_graph(self.project)
+    for otherid in sorted(graph.reverse.get(issue.id, ())):
+        otherissue = graph.issues[otherid]
+        otherissue.dependencies.remove(issue.id)
+        graph.set_dependencies(otherid, otherissue.dependencies)
+        self.store_issue(otherissue)
+    graph.remove(issue.id)
 
     olddropmain(self)
 
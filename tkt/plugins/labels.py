@@ -1,6 +1,6 @@
-import collections
 import datetime
 
+import tkt.aggregate
 import tkt.commands
 import tkt.models
 
@@ -70,29 +70,26 @@ class Label(tkt.commands.Command):
                 self.gather_creator(),
                 self.editor_prompt("Comment"))
 
+def issue_labels(issue):
+    return issue.labels or []
+
 class Labeled(tkt.commands.Command):
     usage = "[<label>]"
 
     usageinfo = "show the tickets with a particular label, or any labels"
 
     def main(self):
+        labeled = tkt.aggregate.aggregate(self.project.issues, issue_labels)
         if not self.parsed_args:
-            self.display_all_labeled()
+            self.display_all_labeled(labeled[issue_labels])
         else:
-            label = self.parsed_args[0]
-            for issue in self.project.issues:
-                if label in (issue.labels or []):
-                    print issue.view_one_line()
-
-    def display_all_labeled(self):
-        data = collections.defaultdict(list)
-        for issue in self.project.issues:
-            for label in (issue.labels or []):
-                data[label].append(issue)
-
-        for label, issues in data.iteritems():
+            for issue in labeled.issues(issue_labels, self.parsed_args[0]):
+                print issue.view_one_line()
+
+    def display_all_labeled(self, groups):
+        for label, group in groups.iteritems():
             print "%s\n  %s" % (label, "\n  ".join(
-                i.view_one_line() for i in issues))
+                i.view_one_line() for i in group.issues))
 
 class Unlabel(tkt.commands.Command):
     usage = "<ticket> [<label>]"
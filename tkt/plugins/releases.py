@@ -1,14 +1,20 @@
 import datetime
 
+import tkt.aggregate
 import tkt.commands
+import tkt.config
 import tkt.files
 import tkt.flextime
+import tkt.index
+import tkt.locking
 import tkt.models
+import tkt.utils
 
 
 tkt.models.Issue.fields.append("release") # string, the name
 tkt.models.ProjectConfig.fields.append("releases")
 tkt.models.Issue.display.append("release")
+tkt.index.SUMMARY_FIELDS.insert(0, "release")
 
 tkt.commands.Search.options.append({
     'short': '-e',
@@ -38,8 +44,47 @@ def view_release(self):
     return self.release or ""
 tkt.models.Issue.view_release = view_release
 
+def releases_as_of(self):
+    "the releases, with any released after the --as-of time still unreleased"
+    releases = dict(self.project.releases)
+    if self.as_of is not None:
+        for release, released in releases.items():
+            if released and released > self.as_of:
+                releases[release] = None
+    return releases
+
+# free tickets have release None or ''
+def issue_release(issue):
+    return issue.release or None
+
+def issues_by_release(self):
+    """{release or None: its tickets}, each ticket loaded when it's looked at
+
+    with the index, the tickets get grouped (and closed ones left out unless
+    they're all shown) by their indexed fields. a release with only closed
+    tickets still gets an empty list.
+    """
+    if self.as_of is not None or not tkt.index.available():
+        summary = tkt.aggregate.aggregate(self.issues, issue_release)
+        return dict((release, group.issues) for release, group in
+                    summary[issue_release].iteritems())
+
+    issuelist = self.issues
+    releases = self.project.issue_field('release')
+    statuses = self.project.issue_field('status')
+    positions = {}
+    for i, issueid in enumerate(self.project.listed_issue_ids):
+        release = positions.setdefault(releases.get(issueid) or None, [])
+        if self.parsed_options.show_all or \
+                statuses.get(issueid) != tkt.models.Issue.CLOSED:
+            release.append(i)
+
+    return dict((release, tkt.utils.LazySequence(len(p),
+                    lambda i, p=p: issuelist[p[i]]))
+                for release, p in positions.iteritems())
+
 def todomain(self):
-    releases = self.project.releases
+    releases = releases_as_of(self)
     releasekeys = releases.keys()
     tomorrow = datetime.datetime.now() + datetime.timedelta(1)
     releasekeys.sort(key=lambda k: (releases[k] or tomorrow, k))
@@ -49,34 +94,39 @@ def todomain(self):
         if release not in releases:
             self.fail("unrecognized release %s" % release)
 
+    byrelease = issues_by_release(self)
+
+    if self.parsed_args and self.parsed_args[0]:
         print "Release %s:" % release.title()
-        self.display_issues([i for i in self.project.issues
-                             if i.release == release])
+        self.display_issues(byrelease.get(release, []))
         print ""
         return
 
-    for release in releasekeys:
-        if not self.parsed_options.show_all and releases[release]:
-            continue
+    # every window gets loaded before any is printed, so the names line up
+    shown = [(release, self.window(byrelease.get(release, [])))
+             for release in releasekeys
+             if self.parsed_options.show_all or not releases[release]]
+    unscheduled = None
+    if None in byrelease:
+        unscheduled = self.window(byrelease[None])
 
+    for release, issues in shown:
         print "Release %s:" % release.title()
-        self.display_issues([i for i in self.project.issues
-                             if i.release == release])
+        self.print_issues(issues)
         print ""
 
-    unscheduled = [i for i in self.project.issues if not i.release]
-    if unscheduled:
+    if unscheduled is not None:
         print "Unscheduled:"
-        self.display_issues(unscheduled)
+        self.print_issues(unscheduled)
 
-    if not releasekeys and not unscheduled:
-        self.display_issues([])
+    if not releasekeys and unscheduled is None:
+        self.print_issues([])
 
 tkt.commands.Todo.main = todomain
 tkt.commands.Todo.usage = "[<release>]"
 
 def statusmain(self):
-    releases = self.project.releases
+    releases = releases_as_of(self)
     releasetexts = []
     releasekeys = releases.keys()
     tomorrow = datetime.datetime.now() + datetime.timedelta(1)
@@ -91,14 +141,11 @@ def statusmain(self):
     releasetexts.append("free tickets")
     longest = max(map(len, releasetexts))
 
-    for i, release in enumerate(releasekeys):
-        text = self.display_status([iss for iss in self.project.issues
-                                    if iss.release == release])
-        print "%s  %s" % (releasetexts[i].ljust(longest), text)
+    counts = tkt.aggregate.split(self.summary())
 
-    text = self.display_status([iss for iss in self.project.issues
-                                if not iss.release])
-    print "%s  %s" % (releasetexts[-1].ljust(longest), text)
+    for i, release in enumerate(releasekeys + [None]):
+        text = self.display_status(counts.get(release, {}))
+        print "%s  %s" % (releasetexts[i].ljust(longest), text)
 
 tkt.commands.Status.main = statusmain
 
@@ -204,12 +251,16 @@ class Release(tkt.commands.Command):
 
     usage = "<releasename>"
 
+    lock_repo = tkt.locking.EXCLUSIVE
+
     def main(self):
         if not (self.parsed_args and self.parsed_args[0]):
             self.fail("releasename argument required")
 
         name = self.parsed_args[0]
 
+        # re-read project.yaml now that nobody else can be writing it
+        tkt.config.reload(reread=True)
         releases = self.project.releases
 
         if name not in releases:
@@ -253,7 +304,6 @@ class ChangeLog(tkt.commands.Command):
             self.fail("releasename argument required")
 
         name = self.parsed_args[0]
-
         releases = self.project.releases
 
         if name not in releases:
@@ -264,14 +314,12 @@ class ChangeLog(tkt.commands.Command):
         print "== %s / %s" % (name,
                 released and released.strftime("%Y-%m-%d") or "unreleased")
 
-        empty = True
-
-        for issue in self.project.issues:
-            if issue.release == name:
-                print "* (%s) %s" % (issue.type, issue.title)
-                empty = False
+        issues = tkt.aggregate.aggregate(self.project.issues,
+                                         'release').issues('release', name)
+        for issue in issues:
+            print "* (%s) %s" % (issue.type, issue.title)
 
-        if empty:
+        if not issues:
             print "(empty milestone)"
 
 tkt.commands.aliases('releasenotes')(ChangeLog)
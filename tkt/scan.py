@@ -0,0 +1,54 @@
+import itertools
+import mmap
+import os
+import re
+
+import tkt.utils
+
+
+CHUNKSIZE = 64
+
+def _scan_chunk(args):
+    pattern, flags, paths = args
+    regex = re.compile(pattern, flags)
+
+    found = []
+    matched_dirs = set()
+    for path in paths:
+        # one hit per ticket directory is all grep needs
+        dirname = os.path.dirname(path)
+        if dirname in matched_dirs:
+            continue
+
+        fp = open(path, 'rb')
+        try:
+            if not os.fstat(fp.fileno()).st_size:
+                # zero-length files can't be mapped
+                continue
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if regex.search(buf):
+                    found.append(path)
+                    matched_dirs.add(dirname)
+            finally:
+                buf.close()
+        finally:
+            fp.close()
+
+    return found
+
+def scan(pattern, paths, flags=re.M, processes=None):
+    """the paths of the files that contain a match for the regular expression
+
+    each file is mmapped and searched in place, and the paths are spread in
+    chunks over a pool with a process per cpu.
+    """
+    re.compile(pattern, flags) # report a bad expression here, not in a child
+
+    paths = sorted(paths)
+    chunks = [(pattern, flags, paths[i:i + CHUNKSIZE])
+              for i in xrange(0, len(paths), CHUNKSIZE)]
+
+    found = tkt.utils.parallel_map(_scan_chunk, chunks, threshold=2,
+                                   processes=processes, chunksize=1)
+    return list(itertools.chain(*found))
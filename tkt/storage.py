@@ -0,0 +1,503 @@
+import cPickle
+import contextlib
+import fcntl
+import glob
+import mmap
+import os
+import shutil
+import struct
+import subprocess
+
+import tkt.config
+import tkt.files
+import tkt.index
+import tkt.sync
+
+
+def backend():
+    if '_backend' not in globals():
+        name = tkt.config.project().storage
+        if name not in backends:
+            raise ValueError("unknown storage backend: %s" % name)
+        globals()['_backend'] = backends[name]()
+    return globals()['_backend']
+
+def reload():
+    "start over with a fresh backend, dropping anything it had loaded"
+    globals().pop('_backend', None)
+
+def use_revision(rev):
+    "read the tickets as they were at a git revision, until the next reload"
+    storage = GitStorage(rev)
+    revisions = globals().setdefault('_revisions', {})
+    globals()['_backend'] = revisions.setdefault(storage.revision, storage)
+
+def revision():
+    "the git commit the tickets are being read from, if it isn't the tree"
+    return getattr(globals().get('_backend'), 'revision', None)
+
+class RevisionError(ValueError):
+    pass
+
+def convert(source, target):
+    for issueid in source.issue_ids():
+        for eventid in source.event_ids(issueid):
+            target.write_event(issueid, eventid,
+                               source.read_event(issueid, eventid))
+        target.write_issue(issueid, source.read_issue(issueid))
+
+class FileStorage(object):
+    "one directory per ticket, one yaml file for the ticket and each event"
+
+    name = 'files'
+
+    def _ticketsdir(self):
+        return os.path.join(tkt.config.datapath(), "tickets")
+
+    def issue_ids(self):
+        names = set(glob.glob(tkt.files.issue_filename("*")))
+        names.update(path for path in tkt.files.pending_paths()
+                     if os.path.basename(path) == "ticket.yaml")
+        return sorted(os.path.basename(os.path.dirname(n)) for n in names)
+
+    def listing_version(self):
+        "changes whenever a ticket is added or removed"
+        if not os.path.isdir(self._ticketsdir()):
+            return None
+        return os.stat(self._ticketsdir()).st_mtime
+
+    def refresh(self):
+        "every read goes to the files, so there is nothing to catch up with"
+
+    def has_issue(self, issueid):
+        path = tkt.files.issue_filename(issueid)
+        return tkt.files.pending(path) is not None or os.path.isfile(path)
+
+    def issue_version(self, issueid):
+        path = tkt.files.issue_filename(issueid)
+        text = tkt.files.pending(path)
+        if text is not None:
+            return 'pending', len(text)
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+
+    def history_version(self, issueid):
+        "changes whenever the ticket or any of its events do"
+        issuedir = os.path.dirname(tkt.files.issue_filename(issueid))
+        pending = [path for path in tkt.files.pending_paths()
+                   if os.path.dirname(path) == issuedir]
+        if pending:
+            return 'pending', self.issue_version(issueid), sorted(pending)
+        return self.issue_version(issueid), os.stat(issuedir).st_mtime
+
+    def read_issue(self, issueid):
+        return tkt.files.read(tkt.files.issue_filename(issueid))
+
+    def write_issue(self, issueid, text):
+        tkt.files.write(tkt.files.issue_filename(issueid), text)
+        tkt.sync.ticket_changed(issueid)
+
+    def event_ids(self, issueid):
+        issuedir = os.path.dirname(tkt.files.issue_filename(issueid))
+        names = set(os.path.basename(path) for path in
+                    tkt.files.pending_paths()
+                    if os.path.dirname(path) == issuedir)
+        if os.path.isdir(issuedir):
+            names.update(os.listdir(issuedir))
+        return sorted(name[:-5] for name in names
+                      if name.endswith(".yaml") and name != "ticket.yaml")
+
+    def read_event(self, issueid, eventid):
+        return tkt.files.read(tkt.files.event_filename(issueid, eventid))
+
+    def write_event(self, issueid, eventid, text):
+        tkt.files.write(tkt.files.event_filename(issueid, eventid), text)
+        tkt.sync.ticket_changed(issueid)
+
+    def drop_issue(self, issueid):
+        issuedir = os.path.dirname(tkt.files.issue_filename(issueid))
+        tkt.files.discard(issuedir)
+        if os.path.isdir(issuedir):
+            shutil.rmtree(issuedir)
+
+    def destroy(self):
+        if os.path.isdir(self._ticketsdir()):
+            shutil.rmtree(self._ticketsdir())
+
+class PackedStorage(object):
+    """every ticket revision and event appended to a few large segment files
+
+    segments never change once written. a separate, append-only offsets file
+    records where each record lives, so opening the store means reading that
+    one file rather than walking a directory per ticket. reads are served
+    out of mmaps of the segments.
+    """
+
+    name = 'packed'
+
+    FOLDERNAME = 'packed'
+    OFFSETSFILENAME = 'offsets'
+    SEGMENT_SIZE = 64 * 1024 * 1024
+
+    TICKET = 't'
+    EVENT = 'e'
+    DROP = 'd'
+
+    # kind, ticket id, event id, payload length
+    HEADER = struct.Struct("!c32s32sI")
+
+    # kind, ticket id, event id, segment number, payload offset, length
+    OFFSET = struct.Struct("!c32s32sIQI")
+
+    def _path(self, *parts):
+        return os.path.join(tkt.config.datapath(), self.FOLDERNAME, *parts)
+
+    def _segment_path(self, segment):
+        return self._path("segment-%06d.log" % segment)
+
+    def _segments(self):
+        names = glob.glob(self._path("segment-*.log"))
+        return sorted(int(os.path.basename(n)[8:-4]) for n in names)
+
+    def _load(self):
+        if hasattr(self, "_tickets"):
+            return
+
+        self._tickets = {}
+        self._events = {}
+        self._maps = {}
+        self._end = (0, 0)
+        self._offsets_read = 0
+
+        if not os.path.isdir(self._path()):
+            os.makedirs(self._path())
+
+        with self._locked():
+            self._recover()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """hold the offsets file exclusively, having read all that's in it
+
+        every process appending to the store or recovering it does so with
+        this lock held, so records never interleave and only a writer that
+        died leaves a partial record behind.
+        """
+        fp = open(self._path(self.OFFSETSFILENAME), 'a+b')
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            self._offsets = fp
+            self._catch_up()
+            yield
+        finally:
+            self._offsets = None
+            fp.close()
+
+    def _catch_up(self):
+        "apply the offsets other processes have written since the last time"
+        fp = self._offsets
+        fp.seek(self._offsets_read)
+        data = fp.read()
+
+        size = self.OFFSET.size
+        usable = len(data) - len(data) % size
+        for start in xrange(0, usable, size):
+            self._apply(*self.OFFSET.unpack_from(data, start))
+        self._offsets_read += usable
+
+        if usable < len(data):
+            # a writer died in the middle of an offset
+            fp.truncate(self._offsets_read)
+
+    def _apply(self, kind, issueid, eventid, segment, offset, length):
+        issueid = issueid.rstrip('\0')
+        eventid = eventid.rstrip('\0')
+        location = (segment, offset, length)
+        self._end = max(self._end, (segment, offset + length))
+
+        if kind == self.TICKET:
+            self._tickets[issueid] = location
+            self._events.setdefault(issueid, {})
+        elif kind == self.EVENT:
+            self._events.setdefault(issueid, {})[eventid] = location
+        elif kind == self.DROP:
+            self._tickets.pop(issueid, None)
+            self._events.pop(issueid, None)
+
+    def _recover(self):
+        """index any records that made it into a segment but not the offsets
+
+        only ever called with the lock held.
+        """
+        segment, position = self._end
+        for seg in self._segments():
+            if seg < segment:
+                continue
+            if seg > segment:
+                position = 0
+
+            fp = open(self._segment_path(seg), 'r+b')
+            try:
+                while 1:
+                    fp.seek(position)
+                    header = fp.read(self.HEADER.size)
+                    if len(header) < self.HEADER.size:
+                        break
+                    kind, issueid, eventid, length = \
+                            self.HEADER.unpack(header)
+                    offset = position + self.HEADER.size
+                    if len(fp.read(length)) < length:
+                        break
+                    self._index(kind, issueid, eventid, seg, offset, length)
+                    position = offset + length
+
+                # chop off a partially written trailing record
+                fp.truncate(position)
+            finally:
+                fp.close()
+
+    def _index(self, kind, issueid, eventid, segment, offset, length):
+        "record an offset, with the lock held"
+        self._offsets.seek(0, os.SEEK_END)
+        self._offsets.write(self.OFFSET.pack(kind, issueid, eventid, segment,
+                                             offset, length))
+        self._offsets.flush()
+        self._offsets_read += self.OFFSET.size
+        self._apply(kind, issueid, eventid, segment, offset, length)
+
+    def _append(self, kind, issueid, eventid, payload):
+        self._load()
+
+        with self._locked():
+            # other processes may have appended since this one last looked
+            self._recover()
+
+            segment = self._end[0]
+            path = self._segment_path(segment)
+            if os.path.exists(path) and \
+                    os.path.getsize(path) >= self.SEGMENT_SIZE:
+                segment += 1
+                path = self._segment_path(segment)
+
+            fp = open(path, 'ab')
+            try:
+                fp.seek(0, os.SEEK_END)
+                offset = fp.tell() + self.HEADER.size
+                fp.write(self.HEADER.pack(kind, issueid, eventid,
+                                          len(payload)) + payload)
+            finally:
+                fp.close()
+
+            self._index(kind, issueid, eventid, segment, offset, len(payload))
+
+    def _read(self, location):
+        segment, offset, length = location
+        buf = self._maps.get(segment)
+        if buf is None or len(buf) < offset + length:
+            fp = open(self._segment_path(segment), 'rb')
+            try:
+                buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                fp.close()
+            self._maps[segment] = buf
+        return buf[offset:offset + length]
+
+    def issue_ids(self):
+        self._load()
+        return sorted(self._tickets)
+
+    def listing_version(self):
+        "changes whenever a ticket is added or removed"
+        path = self._path(self.OFFSETSFILENAME)
+        if not os.path.exists(path):
+            return None
+        return os.path.getsize(path)
+
+    def refresh(self):
+        "catch up with the records other processes have appended"
+        if hasattr(self, "_tickets"):
+            with self._locked():
+                pass
+
+    def has_issue(self, issueid):
+        self._load()
+        return issueid in self._tickets
+
+    def issue_version(self, issueid):
+        self._load()
+        return self._tickets[issueid]
+
+    def history_version(self, issueid):
+        "changes whenever the ticket or any of its events do"
+        self._load()
+        events = self._events.get(issueid, {})
+        return self._tickets[issueid], len(events), max(events.values() or
+                                                         [None])
+
+    def read_issue(self, issueid):
+        self._load()
+        return self._read(self._tickets[issueid])
+
+    def write_issue(self, issueid, text):
+        self._append(self.TICKET, issueid, '', text)
+
+    def event_ids(self, issueid):
+        self._load()
+        return sorted(self._events.get(issueid, ()))
+
+    def read_event(self, issueid, eventid):
+        self._load()
+        return self._read(self._events[issueid][eventid])
+
+    def write_event(self, issueid, eventid, text):
+        self._append(self.EVENT, issueid, eventid, text)
+
+    def drop_issue(self, issueid):
+        self._append(self.DROP, issueid, '', '')
+
+    def destroy(self):
+        for buf in getattr(self, "_maps", {}).itervalues():
+            buf.close()
+        if os.path.isdir(self._path()):
+            shutil.rmtree(self._path())
+        for attr in ("_tickets", "_events", "_maps", "_end", "_offsets_read"):
+            self.__dict__.pop(attr, None)
+
+class GitStorage(object):
+    """the tickets in the 'files' layout as they were at a git revision
+
+    every file gets read through one long-running 'git cat-file --batch', so
+    only the blobs actually used come out of the repository. a commit's
+    tree never changes, so its listing gets cached by commit id. the tickets
+    at a revision can't be changed.
+    """
+
+    name = 'git'
+
+    TREESFOLDERNAME = 'git-trees'
+
+    def __init__(self, rev):
+        self.datapath = tkt.config.datapath()
+        self.toplevel = self._git('rev-parse', '--show-toplevel')
+        self.prefix = self._git('rev-parse', '--show-prefix')
+        self.revision = self._git('rev-parse', '--verify', '--quiet',
+                                  '%s^{commit}' % rev,
+                                  error="unknown git revision: %s" % rev)
+        self._proc = None
+
+    def _git(self, *args, **kwargs):
+        proc = subprocess.Popen(('git',) + args,
+                cwd=kwargs.get('cwd', self.datapath),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode:
+            raise RevisionError(kwargs.get('error') or err.strip())
+        return out.strip()
+
+    def _load(self):
+        if hasattr(self, "_tickets"):
+            return
+
+        path = tkt.index.cachepath(self.TREESFOLDERNAME, self.revision)
+        if os.path.exists(path):
+            fp = open(path, 'rb')
+            try:
+                self._tickets, self._trees, self._events = cPickle.load(fp)
+            finally:
+                fp.close()
+            return
+
+        self._tickets, self._trees, self._events = self._list()
+        tkt.files.write(path, cPickle.dumps(
+                (self._tickets, self._trees, self._events),
+                cPickle.HIGHEST_PROTOCOL))
+
+    def _list(self):
+        "blob ids of the tickets and events, and tree ids of their folders"
+        tickets, trees, events = {}, {}, {}
+        prefix = "%stickets/" % self.prefix
+        listing = self._git('ls-tree', '-r', '-t', '-z', self.revision, '--',
+                            prefix, cwd=self.toplevel)
+        for entry in listing.split('\0'):
+            if not entry:
+                continue
+            info, path = entry.split('\t', 1)
+            mode, kind, sha = info.split()
+            parts = path[len(prefix):].split('/')
+
+            if kind == 'tree' and len(parts) == 1:
+                trees[parts[0]] = sha
+            elif kind == 'blob' and len(parts) == 2:
+                issueid, filename = parts
+                if filename == "ticket.yaml":
+                    tickets[issueid] = sha
+                elif filename.endswith(".yaml"):
+                    events.setdefault(issueid, {})[filename[:-5]] = sha
+        return tickets, trees, events
+
+    def _read(self, sha):
+        if self._proc is None:
+            # close_fds, or it would hold on to a server's client sockets
+            self._proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+                    cwd=self.toplevel, stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, close_fds=True)
+
+        self._proc.stdin.write(sha + "\n")
+        self._proc.stdin.flush()
+        header = self._proc.stdout.readline().split()
+        if len(header) != 3:
+            raise RevisionError("missing git object %s" % sha)
+
+        data = self._proc.stdout.read(int(header[2]))
+        self._proc.stdout.read(1) # the newline after the contents
+        return data
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+            self._proc = None
+
+    def _readonly(self, *args):
+        raise RevisionError("tickets can't be changed at a git revision")
+
+    write_issue = write_event = drop_issue = destroy = _readonly
+
+    def issue_ids(self):
+        self._load()
+        return sorted(self._tickets)
+
+    def listing_version(self):
+        return self.revision
+
+    def refresh(self):
+        "a revision never changes"
+
+    def has_issue(self, issueid):
+        self._load()
+        return issueid in self._tickets
+
+    def issue_version(self, issueid):
+        self._load()
+        return self._tickets[issueid]
+
+    def history_version(self, issueid):
+        self._load()
+        return self._trees[issueid]
+
+    def read_issue(self, issueid):
+        self._load()
+        return self._read(self._tickets[issueid])
+
+    def event_ids(self, issueid):
+        self._load()
+        return sorted(self._events.get(issueid, ()))
+
+    def read_event(self, issueid, eventid):
+        self._load()
+        return self._read(self._events[issueid][eventid])
+
+backends = {
+    FileStorage.name: FileStorage,
+    PackedStorage.name: PackedStorage,
+}
@@ -0,0 +1,209 @@
+"""bringing two copies of a project's tickets in step
+
+each side's tickets folder is summed up as a merkle tree: the files in a
+ticket's folder hash into the ticket's hash, the tickets fall into 256
+buckets by the last two digits of their ids, and the buckets hash into the
+root. comparing two trees only descends into the buckets and tickets whose
+hashes differ. the hashes are cached, and every ticket tkt writes gets
+noted down as changed, so only the noted ticket folders and ones that came
+or went get read again. edits made without tkt need a sync --rehash.
+
+events only ever get added, so whichever side is missing one gets a copy.
+a ticket.yaml that differs is taken from the side that has every event the
+other has, and if each side has events the other lacks (or neither does)
+the ticket.yaml edits conflict. tickets made in both copies since they
+last met may have been given the same numbers, those get reported too.
+"""
+import cPickle
+import hashlib
+import os
+import re
+
+import tkt.config
+import tkt.files
+import tkt.index
+import yaml
+
+
+BUCKETS = 256
+CACHEFILENAME = 'merkle-hashes'
+CHANGEDFILENAME = 'merkle-changed'
+ISSUEFILENAME = 'ticket.yaml'
+
+_issueid_regex = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{8}$")
+
+def _digest(pairs):
+    return hashlib.sha1("".join("%s %s\n" % pair for pair in pairs)).hexdigest()
+
+def _read(path):
+    fp = open(path, 'rb')
+    try:
+        return fp.read()
+    finally:
+        fp.close()
+
+def _changed_path(datapath):
+    return os.path.join(tkt.index.cachefolder(datapath), CHANGEDFILENAME)
+
+def _note_changed(datapath, issueid):
+    fp = open(_changed_path(datapath), 'a')
+    try:
+        fp.write(issueid + "\n")
+    finally:
+        fp.close()
+
+def ticket_changed(issueid, datapath=None):
+    "note a ticket for hashing again, once the transaction is committed"
+    datapath = datapath or tkt.config.datapath()
+    tkt.files.on_commit(lambda: _note_changed(datapath, issueid))
+
+class HashTree(object):
+    "the merkle tree over the tickets folder in a data folder"
+
+    def __init__(self, datapath, rehash=False):
+        self.datapath = datapath
+        self.ticketsdir = os.path.join(datapath, "tickets")
+        self.cachefile = os.path.join(tkt.index.cachefolder(datapath),
+                                      CACHEFILENAME)
+
+        self.folders = {} # ticket id: {filename: hash}
+        self._build(rehash)
+
+        self.tickets = {}
+        self.buckets = [{} for i in xrange(BUCKETS)]
+        for issueid, files in self.folders.iteritems():
+            digest = _digest(sorted(files.iteritems()))
+            self.tickets[issueid] = digest
+            self.buckets[int(issueid[-2:], 16)][issueid] = digest
+
+        self.bucket_hashes = [_digest(sorted(bucket.iteritems()))
+                              for bucket in self.buckets]
+        self.root = _digest(enumerate(self.bucket_hashes))
+
+    def _build(self, rehash):
+        cached = {}
+        if not rehash and os.path.exists(self.cachefile):
+            cached = cPickle.loads(_read(self.cachefile))
+
+        changedfile = _changed_path(self.datapath)
+        noted = set()
+        if os.path.exists(changedfile):
+            noted = set(_read(changedfile).split())
+            # the notes are in the cache once it's written
+            tkt.files.on_commit(lambda: os.remove(changedfile))
+
+        names = []
+        if os.path.isdir(self.ticketsdir):
+            names = filter(_issueid_regex.match, os.listdir(self.ticketsdir))
+
+        changed = False
+        for issueid in names:
+            files = cached.get(issueid)
+            if files is None or issueid in noted:
+                files = self._hash_folder(
+                        os.path.join(self.ticketsdir, issueid))
+                changed = True
+            self.folders[issueid] = files
+
+        if changed or len(cached) != len(self.folders):
+            tkt.files.write(self.cachefile, cPickle.dumps(self.folders,
+                    cPickle.HIGHEST_PROTOCOL))
+
+    def _hash_folder(self, folder):
+        return dict((name, hashlib.sha1(_read(os.path.join(folder, name)))
+                           .hexdigest())
+                    for name in os.listdir(folder) if name.endswith(".yaml"))
+
+    def path(self, issueid, filename):
+        return os.path.join(self.ticketsdir, issueid, filename)
+
+    def read(self, issueid, filename):
+        return _read(self.path(issueid, filename))
+
+    def files(self, issueid):
+        return self.folders[issueid]
+
+def differing_tickets(here, there):
+    "ids of the tickets that aren't the same on both sides"
+    if here.root == there.root:
+        return []
+
+    issueids = []
+    for bucket in xrange(BUCKETS):
+        if here.bucket_hashes[bucket] == there.bucket_hashes[bucket]:
+            continue
+        ours, theirs = here.buckets[bucket], there.buckets[bucket]
+        issueids.extend(issueid for issueid in set(ours) | set(theirs)
+                        if ours.get(issueid) != theirs.get(issueid))
+    return sorted(issueids)
+
+class Plan(object):
+    "the copies that bring two sides in step, and the conflicts in the way"
+
+    def __init__(self, here, there, prefer=None):
+        self.here = here
+        self.there = there
+        self.copies = [] # (from tree, to tree, ticket id, filename)
+        self.conflicts = [] # ticket ids
+        self.new = {here: [], there: []} # ids of the tickets only on a side
+
+        for issueid in differing_tickets(here, there):
+            self._plan_ticket(issueid, prefer)
+
+    def _copy(self, source, target, issueid, filenames):
+        self.copies.extend((source, target, issueid, filename)
+                           for filename in sorted(filenames))
+
+    def _plan_ticket(self, issueid, prefer):
+        here, there = self.here, self.there
+        if issueid not in there.folders:
+            self._copy(here, there, issueid, here.files(issueid))
+            self.new[here].append(issueid)
+            return
+        if issueid not in here.folders:
+            self._copy(there, here, issueid, there.files(issueid))
+            self.new[there].append(issueid)
+            return
+
+        ours, theirs = here.files(issueid), there.files(issueid)
+        ourevents = set(ours).difference([ISSUEFILENAME])
+        theirevents = set(theirs).difference([ISSUEFILENAME])
+        self._copy(here, there, issueid, ourevents - theirevents)
+        self._copy(there, here, issueid, theirevents - ourevents)
+
+        for name in ourevents & theirevents:
+            if ours[name] != theirs[name]:
+                # events aren't supposed to change once they're written
+                self.conflicts.append(issueid)
+                return
+
+        if ours.get(ISSUEFILENAME) == theirs.get(ISSUEFILENAME):
+            return
+        if theirevents < ourevents or prefer == 'here':
+            self._copy(here, there, issueid, [ISSUEFILENAME])
+        elif ourevents < theirevents or prefer == 'there':
+            self._copy(there, here, issueid, [ISSUEFILENAME])
+        else:
+            self.conflicts.append(issueid)
+
+    def _numbers(self, tree):
+        numbers = {}
+        for issueid in self.new[tree]:
+            data = yaml.load(tree.read(issueid, ISSUEFILENAME)) or {}
+            if data.get('number') is not None:
+                numbers.setdefault(data['number'], []).append(issueid)
+        return numbers
+
+    def number_clashes(self):
+        """(number, ids here, ids there) for the numbers given out on both
+        sides to different new tickets"""
+        ours, theirs = self._numbers(self.here), self._numbers(self.there)
+        return [(number, ours[number], theirs[number])
+                for number in sorted(set(ours) & set(theirs))]
+
+    def run(self):
+        "make the copies, as part of the current transaction"
+        for source, target, issueid, filename in self.copies:
+            tkt.files.write(target.path(issueid, filename),
+                            source.read(issueid, filename))
+            ticket_changed(issueid, target.datapath)
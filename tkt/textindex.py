@@ -0,0 +1,287 @@
+import collections
+import math
+import re
+import sre_constants
+import sre_parse
+
+import tkt.index
+import tkt.storage
+import yaml
+
+
+_word_regex = re.compile(r"\w+", re.U)
+
+def trigrams():
+    if '_trigrams' not in globals():
+        globals()['_trigrams'] = TrigramIndex(tkt.index.connection())
+    return globals()['_trigrams']
+
+def split_trigrams(text):
+    text = text.lower()
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+def split_words(text):
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return [w.encode('utf-8') for w in _word_regex.findall(text.lower())]
+
+def _literal(code):
+    if code < 256:
+        return chr(code)
+    return unichr(code).encode('utf-8')
+
+def _literal_runs(parsed):
+    runs = []
+    run = []
+    for op, arg in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(_literal(arg))
+            continue
+
+        runs.append("".join(run))
+        run = []
+
+        # a group's contents are required just like the surrounding text
+        if op == sre_constants.SUBPATTERN:
+            runs.extend(_literal_runs(arg[-1]))
+    runs.append("".join(run))
+    return runs
+
+def required_literals(pattern):
+    "strings that any match of the regular expression has to contain"
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, OverflowError):
+        return []
+    return [run for run in _literal_runs(parsed) if run]
+
+def _documents(storage, issueid):
+    yield '', storage.read_issue(issueid)
+    for eventid in storage.event_ids(issueid):
+        yield eventid, storage.read_event(issueid, eventid)
+
+class DocumentIndex(object):
+    """bookkeeping shared by the indexes over ticket and event documents
+
+    every ticket.yaml and every event is a document, identified by the
+    ticket id and the event id ('' for the ticket itself). subclasses decide
+    what gets indexed for a document and how it's queried.
+    """
+
+    # the table of indexed documents and the meta flag set once it's built
+    DOCS = None
+    BUILT = None
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @property
+    def built(self):
+        return bool(tkt.index.metadata().getmeta(self.BUILT))
+
+    def build(self):
+        storage = tkt.storage.backend()
+        with self.conn:
+            for row in list(self.conn.execute("SELECT doc FROM %s" %
+                                              self.DOCS)):
+                self._unindex(row[0])
+            self.conn.execute("DELETE FROM %s" % self.DOCS)
+            for issueid in storage.issue_ids():
+                self._add_issue(storage, issueid)
+            tkt.index.metadata().setmeta(self.BUILT, True)
+
+    def refresh(self):
+        "pick up ticket and event changes that were made outside of tkt"
+        storage = tkt.storage.backend()
+
+        known = {}
+        for issueid, eventid, version in self.conn.execute(
+                "SELECT issueid, eventid, version FROM %s" % self.DOCS):
+            known.setdefault(issueid, {})[eventid] = version
+
+        with self.conn:
+            for issueid in storage.issue_ids():
+                docs = known.pop(issueid, None)
+                if docs is None:
+                    self._add_issue(storage, issueid)
+                    continue
+
+                version = repr(storage.issue_version(issueid))
+                if docs.pop('', None) != version:
+                    self._store(issueid, '', version,
+                                storage.read_issue(issueid))
+
+                for eventid in storage.event_ids(issueid):
+                    if docs.pop(eventid, None) is None:
+                        self._store(issueid, eventid, '',
+                                    storage.read_event(issueid, eventid))
+
+                for eventid in docs:
+                    self._remove(issueid, eventid)
+
+            for issueid in known:
+                self._drop(issueid)
+
+    def _add_issue(self, storage, issueid):
+        version = repr(storage.issue_version(issueid))
+        for eventid, text in _documents(storage, issueid):
+            self._store(issueid, eventid, eventid and '' or version, text)
+
+    def _remove(self, issueid, eventid):
+        row = self.conn.execute("SELECT doc FROM %s " % self.DOCS +
+                "WHERE issueid = ? AND eventid = ?",
+                (issueid, eventid)).fetchone()
+        if row is not None:
+            self._unindex(row[0])
+            self.conn.execute("DELETE FROM %s WHERE doc = ?" % self.DOCS, row)
+
+    def _store(self, issueid, eventid, version, text):
+        self._remove(issueid, eventid)
+        doc = self.conn.execute("INSERT INTO %s " % self.DOCS +
+                "(issueid, eventid, version) VALUES (?, ?, ?)",
+                (issueid, eventid, version)).lastrowid
+        self._index(doc, eventid, text)
+
+    def store(self, issueid, eventid, text):
+        if eventid:
+            version = ''
+        else:
+            version = repr(tkt.storage.backend().issue_version(issueid))
+        with self.conn:
+            self._store(issueid, eventid, version, text)
+
+    def _drop(self, issueid):
+        for row in list(self.conn.execute(
+                "SELECT doc FROM %s WHERE issueid = ?" % self.DOCS,
+                (issueid,))):
+            self._unindex(row[0])
+        self.conn.execute("DELETE FROM %s WHERE issueid = ?" % self.DOCS,
+                          (issueid,))
+
+    def drop(self, issueid):
+        with self.conn:
+            self._drop(issueid)
+
+    def _index(self, doc, eventid, text):
+        raise NotImplementedError()
+
+    def _unindex(self, doc):
+        raise NotImplementedError()
+
+class TrigramIndex(DocumentIndex):
+    """which tickets and events contain each three-character sequence
+
+    lookups narrow a regular expression down to the documents containing all
+    of its required literal text, which then still have to be checked
+    against the real expression. the index is only kept once it has been
+    built, and from then on every stored ticket or event updates it.
+    """
+
+    DOCS = "trigram_docs"
+    BUILT = "trigrams-built"
+
+    def _index(self, doc, eventid, text):
+        self.conn.executemany(
+                "INSERT INTO trigrams (trigram, doc) VALUES (?, ?)",
+                ((trigram, doc) for trigram in split_trigrams(text)))
+
+    def _unindex(self, doc):
+        self.conn.execute("DELETE FROM trigrams WHERE doc = ?", (doc,))
+
+    def candidates(self, pattern):
+        "(issueid, eventid) pairs of the documents that might match"
+        grams = set()
+        for literal in required_literals(pattern):
+            grams.update(split_trigrams(literal))
+
+        if not grams:
+            return self.conn.execute(
+                    "SELECT issueid, eventid FROM trigram_docs").fetchall()
+
+        grams = sorted(grams)
+        return self.conn.execute('''SELECT issueid, eventid
+                FROM trigram_docs WHERE doc IN (
+                    SELECT doc FROM trigrams WHERE trigram IN (%s)
+                    GROUP BY doc HAVING count(*) = ?)
+                ORDER BY issueid, eventid''' % ", ".join("?" * len(grams)),
+                grams + [len(grams)]).fetchall()
+
+class RankedIndex(DocumentIndex):
+    """an inverted index of the words in titles, descriptions and comments
+
+    results are ranked with okapi bm25. a ticket's score is the sum over its
+    documents (the ticket itself and each of its events), and titles count
+    twice. it is built the first time it's queried and kept up to date by
+    every stored ticket and event after that.
+    """
+
+    DOCS = "text_docs"
+    BUILT = "text-built"
+
+    K1 = 1.2
+    B = 0.75
+
+    def _words(self, eventid, text):
+        data = yaml.load(text) or {}
+        if eventid:
+            parts = [data.get('comment')]
+        else:
+            parts = [data.get('title'), data.get('title'),
+                     data.get('description')]
+        return split_words(" ".join(p for p in parts if p))
+
+    def _index(self, doc, eventid, text):
+        words = self._words(eventid, text)
+        self.conn.execute("UPDATE text_docs SET length = ? WHERE doc = ?",
+                          (len(words), doc))
+        self.conn.executemany(
+                "INSERT INTO postings (term, doc, tf) VALUES (?, ?, ?)",
+                ((term, doc, tf) for term, tf in
+                 collections.Counter(words).iteritems()))
+
+    def _unindex(self, doc):
+        self.conn.execute("DELETE FROM postings WHERE doc = ?", (doc,))
+
+    def search(self, query):
+        "(ticket id, score) pairs for the query, best first"
+        terms = sorted(set(split_words(query)))
+        if not terms:
+            return []
+
+        count, avglength = self.conn.execute(
+                "SELECT count(*), avg(length) FROM text_docs").fetchone()
+        avglength = avglength or 1
+
+        scores = collections.defaultdict(float)
+        for term in terms:
+            postings = self.conn.execute('''SELECT d.issueid, p.tf, d.length
+                    FROM postings p JOIN text_docs d ON p.doc = d.doc
+                    WHERE p.term = ?''', (term,)).fetchall()
+            if not postings:
+                continue
+
+            idf = math.log(1 + (count - len(postings) + 0.5) /
+                           (len(postings) + 0.5))
+            for issueid, tf, length in postings:
+                norm = self.K1 * (1 - self.B + self.B * length / avglength)
+                scores[issueid] += idf * tf * (self.K1 + 1) / (tf + norm)
+
+        return sorted(scores.iteritems(), key=lambda p: (-p[1], p[0]))
+
+def ranked():
+    if '_ranked' not in globals():
+        globals()['_ranked'] = RankedIndex(tkt.index.connection())
+    return globals()['_ranked']
+
+def _indexes():
+    if not tkt.index.available():
+        return []
+    return [index for index in (trigrams(), ranked()) if index.built]
+
+def document_stored(issueid, eventid, text):
+    for index in _indexes():
+        index.store(issueid, eventid, text)
+
+def issue_dropped(issueid):
+    for index in _indexes():
+        index.drop(issueid)
@@ -1,4 +1,98 @@
+import atexit
 import itertools
+import multiprocessing
+import Queue
+import sys
+import threading
+
+
+# below this many items the cost of starting a pool isn't worth it
+PARALLEL_THRESHOLD = 256
+
+def parallel_map(func, items, threshold=PARALLEL_THRESHOLD, processes=None,
+                 chunksize=None):
+    """map func over items, in a process pool if there are enough of them
+
+    results come back lazily and in the order of the items. func and the
+    items have to be picklable.
+    """
+    items = list(items)
+    processes = processes or multiprocessing.cpu_count()
+    if len(items) < threshold or processes < 2:
+        return itertools.imap(func, items)
+
+    chunksize = chunksize or max(1, len(items) // (processes * 4))
+    return _pooled_map(func, items, processes, chunksize)
+
+def _pooled_map(func, items, processes, chunksize):
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(func, items, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# (stopped, thread) for every prefetching thread still running
+_prefetching = set()
+
+def _stop_prefetching():
+    "stop the prefetching threads and wait for them, before teardown starts"
+    for stopped, thread in list(_prefetching):
+        stopped.set()
+        thread.join()
+atexit.register(_stop_prefetching)
+
+def prefetched(gen, depth):
+    """iterate over gen, with a thread reading up to depth items ahead
+
+    exceptions raised by gen come out of the consumer's side, and the thread
+    gives up once the consumer stops iterating (closes the generator), or
+    at the latest when the process exits.
+    """
+    items = Queue.Queue(depth)
+    stopped = threading.Event()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def work():
+        try:
+            for item in gen:
+                if not put((True, item)):
+                    return
+        except:
+            put((False, sys.exc_info()))
+        else:
+            put((False, None))
+        finally:
+            _prefetching.discard(running)
+
+    thread = threading.Thread(target=work)
+    thread.daemon = True
+    running = (stopped, thread)
+    _prefetching.add(running)
+    thread.start()
+
+    try:
+        while 1:
+            isitem, item = items.get()
+            if isitem:
+                yield item
+            elif item is None:
+                return
+            else:
+                raise item[0], item[1], item[2]
+    finally:
+        stopped.set()
 
 
 class LazyLoadingList(object):
@@ -16,9 +110,14 @@ class LazyLoadingList(object):
         append (no evaluation),
         extend (no evaluation),
         sort (evaluates the full generator)
+
+    with a prefetch depth, a background thread evaluates the generator up to
+    that many items ahead of whatever is asking for them.
     """
 
-    def __init__(self, gen, prefix=None, postfix=None):
+    def __init__(self, gen, prefix=None, postfix=None, prefetch=0):
+        if prefetch:
+            gen = prefetched(gen, prefetch)
         self._gen = gen
         self._prefix = []
         self._postfix = []
@@ -142,7 +241,103 @@ class LazyLoadingList(object):
         self._complete = False
 
     def sort(self, *args, **kwargs):
-        self._prefix.extend(self._yield_from_gen())
+        tuple(self._yield_from_gen())
         self._prefix.extend(self._postfix)
         self._postfix[:] = []
         self._prefix.sort(*args, **kwargs)
+
+class _Unloaded(object):
+    "the placeholder for an item that hasn't been loaded yet"
+
+    __slots__ = ['index']
+
+    def __init__(self, index):
+        self.index = index
+
+class LazySequence(object):
+    """a list of a known length whose items are loaded when first needed
+
+    load(index) produces the item at an index. indexing (negative too),
+    slicing and iterating only load the items they touch, and len() doesn't
+    load anything. otherwise it behaves like a list: items can be assigned,
+    deleted, appended, extended and sorted (which loads everything, unlike
+    reorder).
+
+    with a prefetch depth, iteration loads ahead in a background thread.
+    """
+
+    def __init__(self, length, load, prefetch=0):
+        self._items = map(_Unloaded, xrange(length))
+        self._load = load
+        self._prefetch = prefetch
+        self._lock = threading.Lock()
+
+    def _get(self, index):
+        with self._lock:
+            item = self._items[index]
+            if isinstance(item, _Unloaded):
+                item = self._items[index] = self._load(item.index)
+            return item
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return map(self._get, xrange(*index.indices(len(self._items))))
+        if not isinstance(index, (int, long)):
+            raise TypeError("integer index required")
+        if index < 0:
+            index += len(self._items)
+        if not 0 <= index < len(self._items):
+            raise IndexError("index out of range")
+        return self._get(index)
+
+    def __iter__(self):
+        pending = [i for i, item in enumerate(self._items)
+                   if isinstance(item, _Unloaded)]
+        loaded = itertools.imap(self._get, pending)
+        if self._prefetch and pending:
+            loaded = prefetched(loaded, self._prefetch)
+
+        pending = set(pending)
+        try:
+            for index in xrange(len(self._items)):
+                if index in pending:
+                    yield loaded.next()
+                else:
+                    yield self._items[index]
+        finally:
+            # stop a prefetching thread as soon as we're done with it
+            if hasattr(loaded, 'close'):
+                loaded.close()
+
+    def __setitem__(self, index, item):
+        self._items[index] = item
+
+    def __delitem__(self, index):
+        del self._items[index]
+
+    def __repr__(self):
+        return "[%s]" % ", ".join(map(repr, self))
+
+    __unicode__ = __str__ = __repr__
+
+    def pop(self, index=-1):
+        item = self[index]
+        del self[index]
+        return item
+
+    def append(self, item):
+        self._items.append(item)
+
+    def extend(self, items):
+        self._items.extend(items)
+
+    def sort(self, *args, **kwargs):
+        self._items[:] = list(self)
+        self._items.sort(*args, **kwargs)
+
+    def reorder(self, indexes):
+        "put the items in the order of their current indexes, loading none"
+        self._items[:] = [self._items[i] for i in indexes]